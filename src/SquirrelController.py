@@ -1,34 +1,140 @@
 import sys
-import yaml, requests
-from operations import Neo4j
+import logging
+from operations import Neo4j, UnknownNode, QUALIFIERS, predicate_list
+from tracing import Tracer, traced
+from query_cache import QueryCache
+from infores import get_infores_catalog
+from knowledge_graph import KnowledgeGraph, is_partial, is_complete
+from blackboard import compact_blackboard, count_tokens, render, dedupe
 import json
-from conversation import BlackboardConversation
+
+logger = logging.getLogger(__name__)
+
+def is_triple_list(argument):
+    """Whether argument is a non-empty list of complete triples."""
+    return isinstance(argument, list) and len(argument) > 0 and all(is_complete(edge) for edge in argument)
 
 class SquirrelController:
-    def __init__(self, db, pw, curie1, curie2):
-        self.neo4j = Neo4j(db, pw)
+    def __init__(self, db, pw, curie1, curie2, edge_page_size=25, driver=None, model="gpt-4", token_budget=6000,
+                 cache=None, state=None, neo4j=None, prefetch=False, path_max_length=3, path_limit=5):
+        """If state (from get_state) is given, the controller picks up where that one left off instead of starting
+        a new exploration of curie1 and curie2.  If neo4j is given, it is used instead of connecting to db, and is given
+        cache if it doesn't have one of its own.
+        If prefetch is set, likely next queries are run in the background while the LLM is thinking (see prefetch).
+        Nothing is queried here; the seed nodes are looked up when they are first needed (see start)."""
+        self.prefetching = prefetch
+        if prefetch and cache is None:
+            # Prefetched results are handed over through the cache
+            cache = QueryCache()
+        if neo4j is None:
+            # Spans from the controller, its Neo4j and the conversation are collected here and saved with each step
+            self.tracer = Tracer()
+            self.neo4j = Neo4j(db, pw, driver=driver, cache=cache, tracer=self.tracer)
+        else:
+            self.tracer = neo4j.tracer
+            self.neo4j = neo4j
+            if self.neo4j.cache is None:
+                self.neo4j.cache = cache
+        self.model = model
+        # The system prompt plus the blackboard in each request are kept under this, leaving room for the response
+        self.token_budget = token_budget
+        # complete_edge adds at most this many edges at a time, so that hub nodes don't flood the blackboard
+        self.edge_page_size = edge_page_size
+        # find_paths looks for at most path_limit paths of at most path_max_length edges
+        self.path_max_length = path_max_length
+        self.path_limit = path_limit
+        # How far into the results we have already paged, for each partial edge
+        self.edge_offsets = {}
         self.infores_catalog = None
+        # Nodes added to the KG by the last update, which are good guesses for what the LLM will look at next
+        self.new_nodes = []
         self.curie1 = curie1
         self.curie2 = curie2
-        self.name1 = self.neo4j.get_name(curie1)
-        self.name2 = self.neo4j.get_name(curie2)
-        self.kg = self.get_neighborhood_schema(self.name1)
-        self.kg += self.get_neighborhood_schema(self.name2)
+        self.kg = None
+        if state is not None:
+            self.set_state(state)
+
+    def start(self):
+        """Look up the seed nodes and expand both of them, unless that has been done already (or state was restored)."""
+        if self.kg is not None:
+            return
+        self.name1 = self.neo4j.get_name(self.curie1)
+        self.name2 = self.neo4j.get_name(self.curie2)
+        self.kg = KnowledgeGraph(self.get_neighborhood_schemas([self.name1, self.name2]))
         self.summary = ""
         self.observations = []
         self.actions = [{"action": "expand_node", "argument": self.name1}, {"action": "expand_node", "argument": self.name2}]
 
+    def prefetch(self, max_edges=4, max_nodes=4):
+        """If prefetching is on, start the queries for the actions the LLM is most likely to pick next, so that
+        update finds their results in the cache:
+        1. complete_edge on the smallest partial edges around the seed nodes, which are cheap and often chosen
+        2. expand_node on the nodes that the last update added
+        """
+        if not self.prefetching:
+            return
+        self.start()
+        seeds = (self.name1, self.name2)
+        partials = [triple for triple in self.kg.match(subject=self.name1) + self.kg.match(subject=self.name2)
+                    if isinstance(triple[2], int)]
+        partials += [triple for triple in self.kg.match(object=self.name1) + self.kg.match(object=self.name2)
+                     if isinstance(triple[0], int)]
+        partials.sort(key=lambda triple: triple[2] if triple[0] in seeds else triple[0])
+        for edge in partials[:max_edges]:
+            if isinstance(edge[2], int):
+                key = (edge[0], edge[1], "forward")
+            else:
+                key = (edge[2], edge[1], "reverse")
+            self.neo4j.prefetch_edge_page(edge, limit=self.edge_page_size, skip=self.edge_offsets.get(key, 0))
+        for name in self.new_nodes[:max_nodes]:
+            self.neo4j.prefetch_neighborhood_schemas([name])
+
+    def get_state(self):
+        """Return everything needed to recreate this controller's exploration, as json-serializable data."""
+        self.start()
+        return {
+            "curie1": self.curie1,
+            "curie2": self.curie2,
+            "name1": self.name1,
+            "name2": self.name2,
+            "kg": self.kg.to_list(),
+            "observations": self.observations,
+            "summary": self.summary,
+            "actions": self.actions,
+            "nodes": self.neo4j.nodes.entries(),
+            "edge_offsets": [ [list(key), skip] for key, skip in self.edge_offsets.items()]
+        }
+
+    def set_state(self, state):
+        # Registering the nodes in their original order gives every node the same name it had before
+        for curie, name in state.get("nodes", []):
+            self.neo4j.nodes.add(curie, name)
+        self.name1 = state.get("name1") or self.neo4j.get_name(self.curie1)
+        self.name2 = state.get("name2") or self.neo4j.get_name(self.curie2)
+        # json turned the tuples into lists
+        self.kg = KnowledgeGraph(tuple(triple) for triple in state["kg"])
+        self.observations = state["observations"]
+        self.summary = state["summary"]
+        self.actions = state["actions"]
+        self.edge_offsets = {tuple(key): skip for key, skip in state.get("edge_offsets", [])}
+
+    @traced("controller.generate_payload")
     def generate_payload(self):
+        self.start()
+        system_prompt = self.generate_system_prompt()
+        blackboard_budget = self.token_budget - count_tokens(system_prompt, self.model)
+        blackboard = compact_blackboard(self.generate_blackboard(), blackboard_budget, seeds=[self.name1, self.name2],
+                                        model=self.model)
         payload = {
-            "model": "gpt-4",
+            "model": self.model,
             "messages": [
                 {
                     "role": "system",
-                    "content": self.generate_system_prompt()
+                    "content": system_prompt
                 },
                 {
                     "role": "user",
-                    "content": json.dumps(self.generate_blackboard())
+                    "content": render(blackboard)
                 }
             ]
         }
@@ -36,7 +142,7 @@ class SquirrelController:
 
     def generate_blackboard(self):
         blackboard = {
-            "knowledge graph": self.kg,
+            "knowledge graph": self.kg.to_list(),
             "observations": self.observations,
             "summary": self.summary,
             "previous_actions": self.actions
@@ -46,27 +152,113 @@ class SquirrelController:
     def get_neighborhood_schema(self, name):
         return self.neo4j.get_neighborhood_schema(name)
 
+    def get_neighborhood_schemas(self, names):
+        return self.neo4j.get_neighborhood_schemas(names)
+
     def get_edges(self, edge):
-        return self.neo4j.get_edges(edge)
+        """Given a partial edge, return the next page of edges that match it, along with a partial edge that
+        stands for the matching edges that haven't been returned yet (or None if there aren't any)."""
+        if isinstance(edge[2], int):
+            key, count = (edge[0], edge[1], "forward"), edge[2]
+        else:
+            key, count = (edge[2], edge[1], "reverse"), edge[0]
+        skip = self.edge_offsets.get(key, 0)
+        edges, next_skip = self.neo4j.get_edge_page(edge, limit=self.edge_page_size, skip=skip)
+        if next_skip is None:
+            self.edge_offsets.pop(key, None)
+            return edges, None
+        remaining = count - len(edges)
+        if remaining <= 0:
+            # The count was wrong, so a remainder would be too; forget the paging rather than post a count of zero
+            logger.warning("Edge count too low for the edges found", extra={"fields": {"edge": edge}})
+            self.edge_offsets.pop(key, None)
+            return edges, None
+        self.edge_offsets[key] = next_skip
+        if key[2] == "forward":
+            return edges, (edge[0], edge[1], remaining)
+        return edges, (remaining, edge[1], edge[2])
 
-    def detail_edge(self, edge):
-        # These are ignorable because they are either reproducing things we already know or are being handled specifically
-        ignorable_properties = ["biolink:primary_knowledge_source", "predicate", "knowledge_source", "subject", "biolink:aggregator_knowledge_source",
-                                "id", "object"]
-        edge_properties = self.neo4j.detail_edge(edge)
-        print(edge_properties[0])
-        usable_properties = self.generate_source_text(edge_properties[0]["biolink:primary_knowledge_source"])
-        for property in edge_properties[0]:
-            if property in ignorable_properties:
-                continue
+    def find_paths(self, argument):
+        """Run a find_paths action.  The argument is [name, name], optionally followed by the predicates to restrict
+        the paths to, either as a list or one by one; an empty argument means the two seed nodes.  Every edge on the
+        paths is added to the KG, and an observation with one line per path (or saying that there were none, or what
+        was wrong with the argument) is returned."""
+        if isinstance(argument, str):
+            argument = [argument] if argument else []
+        if argument is not None and not isinstance(argument, list):
+            return f"find_paths needs the names of two nodes (or nothing, for {self.name1} and {self.name2}), " \
+                   f"not {json.dumps(argument)}"
+        argument = list(argument or [])
+        if len(argument) == 0:
+            argument = [self.name1, self.name2]
+        if len(argument) < 2 or not isinstance(argument[0], str) or not isinstance(argument[1], str):
+            return f"find_paths needs the names of two nodes (or nothing, for {self.name1} and {self.name2}), " \
+                   f"not {json.dumps(argument)}"
+        # The path triples use the registry's names, so the summaries have to start from them too
+        name1, name2 = self.neo4j.canonical_name(argument[0]), self.neo4j.canonical_name(argument[1])
+        # The LLM may give the predicates as a list or one by one after the names
+        try:
+            predicates = predicate_list(argument[2:])
+        except ValueError:
+            return f"find_paths needs the names of two nodes, optionally followed by predicates, " \
+                   f"not {json.dumps(argument)}"
+        paths = self.neo4j.find_paths(name1, name2, max_length=self.path_max_length, limit=self.path_limit,
+                                      predicates=predicates)
+        # Parallel edges with the same predicate give paths that look the same on the blackboard
+        paths = dedupe(paths, tuple)
+        if len(paths) == 0:
+            return f"No paths of at most {self.path_max_length} edges between {name1} and {name2}"
+        new_nodes = []
+        for path in paths:
+            for triple in path:
+                for name in (triple[0], triple[2]):
+                    if name not in (name1, name2) and name not in new_nodes:
+                        new_nodes.append(name)
+                self.kg.add(triple)
+        self.new_nodes = new_nodes
+        return f"Paths between {name1} and {name2}: " + "; ".join(self.path_summary(name1, path) for path in paths)
+
+    def path_summary(self, start, path):
+        """Render a path as "a -[predicate]-> b <-[predicate]- c", starting from start."""
+        summary = start
+        current = start
+        for subject, predicate, object in path:
+            if subject == current:
+                summary += f" -[{predicate}]-> {object}"
+                current = object
             else:
-                if property == "FAERS_llr":
-                    usable_properties["Log Likelihood Ratio"] = edge_properties[0][property]
-                elif property in ["object_direction_qualifier", "object_aspect_qualifier", "qualified_predicate", "subject_direction_qualifier", "subject_aspect_qualifier"]:
-                    usable_properties[property] = edge_properties[0][property]
-                else:
-                    print(property, edge_properties[0][property])
-        return usable_properties
+                summary += f" <-[{predicate}]- {subject}"
+                current = subject
+        return summary
+
+    def detail_edges(self, edges):
+        """Return the usable details of each complete triple in edges, fetched together: a list with one entry per
+        triple, each a list with one dict per parallel edge (empty if there is no such edge)."""
+        return [[self.usable_properties(properties) for properties in edge_properties]
+                for edge_properties in self.neo4j.detail_edges(edges)]
+
+    def detail_edge(self, edge):
+        return self.detail_edges([edge])[0]
+
+    def usable_properties(self, properties):
+        """Turn the properties of an edge into what the LLM sees: the names and descriptions of its sources,
+        the likelihood ratio from FAERS, its qualifiers and its publications."""
+        logger.debug("edge properties", extra={"fields": properties})
+        usable = self.generate_source_text(properties.get("biolink:primary_knowledge_source"))
+        aggregators = properties.get("biolink:aggregator_knowledge_source")
+        if aggregators:
+            if isinstance(aggregators, str):
+                aggregators = [aggregators]
+            usable["aggregated_by"] = [self.generate_source_text(source).get("source_name", source)
+                                       for source in aggregators]
+        if "FAERS_llr" in properties:
+            usable["Log Likelihood Ratio"] = properties["FAERS_llr"]
+        for qualifier in QUALIFIERS:
+            if qualifier in properties:
+                usable[qualifier] = properties[qualifier]
+        if properties.get("publications"):
+            usable["publications"] = properties["publications"]
+        return usable
 
     def generate_source_text(self, source):
         if self.infores_catalog is None:
@@ -83,11 +275,13 @@ class SquirrelController:
         return source_details
 
     def pull_infores_catalog(self):
-        url = "https://raw.githubusercontent.com/biolink/biolink-model/master/infores_catalog.yaml"
-        direct_yaml =  yaml.load(requests.get(url).text, Loader=yaml.FullLoader)
-        self.infores_catalog = {infores["id"]:infores for infores in direct_yaml["information_resources"]}
+        with self.tracer.span("infores.catalog"):
+            self.infores_catalog = get_infores_catalog()
 
+    @traced("controller.update")
     def update(self, response):
+        self.start()
+        self.new_nodes = []
         # Update the blackboard
         self.actions.append( {"action": response["action"], "argument": response["argument"]} )
         if isinstance(response["new_observations"],list):
@@ -96,25 +290,63 @@ class SquirrelController:
             self.observations.append(response["new_observations"])
         self.summary = response["summary"]
         argument = response["argument"]
-        if response["action"] == "complete_edge":
-            self.kg += self.get_edges(argument)
-            # This is coming in as a list, so we need to turn it into a tuple
-            try:
-                self.kg.remove(tuple(response["argument"]))
-            except ValueError:
-                print("Edge not found in KG" )
-                print(json.dumps(response["argument"]))
-                print('')
-                for edge in self.kg:
-                    print(edge)
-        elif response["action"] == "detail_edge":
-            self.observations.append(f"Edge detail for {response['argument']}: {json.dumps(self.detail_edge(argument))}")
-        elif response["action"] == "expand_node":
-            self.kg += self.get_neighborhood_schema(argument)
-            # Remove dupes
-            self.kg = list(set(self.kg))
-        else:
-            raise Exception("Invalid action:"+response["action"]+" for argument:"+response["argument"])
+        try:
+            if response["action"] == "complete_edge" and not is_partial(argument):
+                # Complete triples have nothing to page through, and anything else can't be looked up
+                self.observations.append(f"complete_edge needs a partial triple (node, predicate, count) or "
+                                         f"(count, predicate, node), not {json.dumps(argument)}")
+            elif response["action"] == "complete_edge":
+                # This is coming in as a list, so we need to turn it into a tuple, and the node may be named by an
+                # alias ("name (curie)") that the KG doesn't use
+                if isinstance(argument[2], int):
+                    requested = (self.neo4j.canonical_name(argument[0]), argument[1], argument[2])
+                else:
+                    requested = (argument[0], argument[1], self.neo4j.canonical_name(argument[2]))
+                partial = requested
+                if partial not in self.kg:
+                    # The count may be stale; find the partial edge for the same node and predicate instead
+                    if isinstance(partial[2], int):
+                        partial = self.kg.partial(partial[0], partial[1], forward=True)
+                    else:
+                        partial = self.kg.partial(partial[2], partial[1], forward=False)
+                if partial is None:
+                    logger.warning("Edge not found in KG", extra={"fields": {"argument": response["argument"]}})
+                    new_edges, remainder = self.get_edges(requested)
+                else:
+                    # Page from the partial in the KG, so that the remainder is counted from its count, not the LLM's
+                    new_edges, remainder = self.get_edges(partial)
+                    self.kg.remove(partial)
+                self.kg.extend(new_edges)
+                self.new_nodes = [edge[2] if isinstance(argument[2], int) else edge[0] for edge in new_edges]
+                if remainder is not None:
+                    self.kg.add(remainder)
+            elif response["action"] == "detail_edge" and not (is_complete(argument) or is_triple_list(argument)):
+                self.observations.append(f"detail_edge needs a complete (node, predicate, node) triple, or a list of "
+                                         f"them, not {json.dumps(argument)}")
+            elif response["action"] == "detail_edge":
+                # The argument is either one triple or a list of them
+                edges = [argument] if is_complete(argument) else argument
+                for edge, details in zip(edges, self.detail_edges(edges)):
+                    if len(details) == 0:
+                        self.observations.append(f"No edge found for {edge}")
+                    else:
+                        self.observations.append(f"Edge detail for {edge}: {json.dumps(details)}")
+            elif response["action"] == "expand_node":
+                for triple in self.get_neighborhood_schema(argument):
+                    # A full count replaces any paging remainder for the same edge, so paging starts over with it
+                    if isinstance(triple[2], int):
+                        self.edge_offsets.pop((triple[0], triple[1], "forward"), None)
+                    else:
+                        self.edge_offsets.pop((triple[2], triple[1], "reverse"), None)
+                    self.kg.add(triple)
+            elif response["action"] == "find_paths":
+                self.observations.append(self.find_paths(argument))
+            else:
+                raise Exception("Invalid action:"+response["action"]+" for argument:"+response["argument"])
+        except UnknownNode as e:
+            # Usually a name that the LLM misspelled or made up; tell it so instead of stopping the exploration
+            self.observations.append(f"{e.args[0]}, so {response['action']} found nothing.  Use names exactly as they "
+                                     f"appear in the knowledge graph.")
 
     def generate_system_prompt(self):
         prompt = \
@@ -130,7 +362,8 @@ The blackboard will be in the following format:
     "knowledge graph": [],
     "observations": [], 
     "summary": "",
-    "previous_actions": []
+    "previous_actions": [],
+    "omitted": {{}}
 }}
 The knowledge graph is a list of (node,edge,node) triples.  
 For new nodes, found by queries, the triples will be partial.  For instance
@@ -146,9 +379,12 @@ It should be a summary of the observations, and the knowledge graph, but it may
 
 Both the observations and the summary must be as concise as possible.
 
-The previous_actions are a list of the previous actions that you have taken.  Repeating actions will not lead to new 
+The previous_actions are a list of the previous [action, argument] pairs that you have taken.  Repeating actions will not lead to new 
 information and should be avoided.
 
+When the blackboard is too large, the oldest and least useful entries are left out, and "omitted" gives the number of each kind
+of entry that was left out.  It is missing when nothing was left out.
+
 You will then respond only in the following JSON format:
 {{
     "new_observations": [],
@@ -158,13 +394,20 @@ You will then respond only in the following JSON format:
 }}
 1. New observations is a list of strings that will be added to the observation on the blackboard for future use by yourself or other reasoning tools.
 2. The summary will also be posted to the blackboard
-3. The action value is one of "complete_edge", "detail_edge", "expand_node".
+3. The action value is one of "complete_edge", "detail_edge", "expand_node", "find_paths".
    3a. If the action is "complete_edge", the argument value is a partial triple (node,predicate,count) or (count,predicate,node) that you would like to complete.
-       In this case, all of the edges that match the partial triple will be added to the KG, which usually add new nodes.
-   3b. If the action is "detail_edge", the argument should be a complete (node,predicate,node) triple. In this case, I will return details about the edge, 
-       often in the form of PUBMED abstracts that support the edge.  I may also return information about the database that supplied the edge, or
-       parameters or qualifications associated with the edge.
+       In this case, up to {self.edge_page_size} of the edges that match the partial triple will be added to the KG, which usually add new nodes.
+       The most highly connected nodes come first.  If more edges match, the partial triple is replaced with one whose count is the
+       number of edges remaining, and you may complete that one to get the next edges.
+   3b. If the action is "detail_edge", the argument should be a complete (node,predicate,node) triple, or a list of them. In this case, I will return
+       details about each edge, often in the form of PUBMED ids that support the edge.  I may also return information about the databases that
+       supplied the edge, or parameters or qualifications associated with the edge.  When there are several edges with the same predicate
+       between two nodes, you will get the details for each of them.
    3c. If the action is "expand_node", the argument should be a node name.  In this case, I will return the partial edges associated with the node.
+   3d. If the action is "find_paths", the argument should be a list of two node names, optionally followed by a list of predicates to use,
+       or an empty list for {self.name1} and {self.name2}.  In this case, I will search the whole KG for up to {self.path_limit} of the shortest
+       paths of at most {self.path_max_length} edges between the two nodes, in either direction, add their edges to the KG and add an
+       observation describing each path.  This can connect nodes much faster than completing edges one hop at a time.
    
    NEVER repeat an action/argument pair that has already been used and is in the "previous_actions" of the blackboard.
    
@@ -173,11 +416,6 @@ You will then respond only in the following JSON format:
 
 
 if __name__ == "__main__":
-    # get the db and pw from the command line
-    db = sys.argv[1]
-    pw = sys.argv[2]
-    curie1 = "MONDO:0010778"  # Cyclic Vomiting Syndrome
-    curie2 = "PUBCHEM.COMPOUND:3776"  # isopropyl alcohol
-    squirrel = SquirrelController(db, pw, curie1, curie2)
-    conversation = BlackboardConversation(squirrel)
-    conversation = conversation.iterate(20)
\ No newline at end of file
+    # Kept for existing scripts; blindsquirrel.py run and resume do the same with more options
+    from blindsquirrel import main
+    main(["resume" if len(sys.argv) > 3 else "run"] + sys.argv[1:])
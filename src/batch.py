@@ -0,0 +1,105 @@
+import os, csv, json, argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operations import Neo4j
+from SquirrelController import SquirrelController
+from conversation import BlackboardConversation
+from llm_client import ChatClient, RequestBudget, BudgetExhausted
+from query_cache import QueryCache
+from tracing import configure_logging
+
+logger = logging.getLogger(__name__)
+
+def read_pairs(path):
+    """Read a list of (curie1, curie2) pairs.  A .jsonl file has one {"curie1": ..., "curie2": ...} object per line.
+    Anything else is read as csv, taking the first two columns of each row and skipping a curie1,curie2 header."""
+    pairs = []
+    with open(path, "r") as inf:
+        if path.endswith(".jsonl"):
+            for line in inf:
+                if line.strip():
+                    row = json.loads(line)
+                    pairs.append( (row["curie1"], row["curie2"]) )
+        else:
+            for row in csv.reader(inf):
+                if len(row) < 2 or row[0].strip().lower() == "curie1":
+                    continue
+                pairs.append( (row[0].strip(), row[1].strip()) )
+    return pairs
+
+def run_pair(db, pw, driver, cache, client, curie1, curie2, steps, prefetch=False):
+    squirrel = SquirrelController(db, pw, curie1, curie2, driver=driver, cache=cache, prefetch=prefetch)
+    try:
+        conversation = BlackboardConversation(squirrel, client=client)
+        conversation.iterate(steps)
+        return conversation.conversation_identifier
+    finally:
+        squirrel.neo4j.close()
+
+def run_batch(db, pw, pairs, steps=20, workers=8, max_in_flight=4, max_requests=None, max_tokens=None,
+              cache_path=None, prefetch=False):
+    """Explore every pair concurrently, with at most workers conversations running at once.
+    All of the conversations share one neo4j driver (and so its connection pool), one query cache (persisted at
+    cache_path if given), one infores catalog, and one ChatClient, so that rate limit pacing, the cap of
+    max_in_flight outstanding LLM requests, and the request/token budget apply to the batch as a whole.  Returns a list of per-pair results in the order the pairs finished."""
+    cache = QueryCache(path=cache_path)
+    shared = Neo4j(db, pw, cache=cache)
+    budget = RequestBudget(max_requests=max_requests, max_tokens=max_tokens)
+    client = ChatClient(os.environ.get("OPENAI_API_KEY"), pool_size=max(workers, 10), max_in_flight=max_in_flight,
+                        budget=budget)
+    results = []
+    def run(curie1, curie2):
+        if budget.exhausted():
+            raise BudgetExhausted("Budget used up before starting")
+        return run_pair(db, pw, driver, cache, client, curie1, curie2, steps, prefetch=prefetch)
+    try:
+        # Connect once here rather than racing to connect from every worker
+        driver = shared.connect()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run, curie1, curie2): (curie1, curie2) for curie1, curie2 in pairs}
+            for done, future in enumerate(as_completed(futures), 1):
+                curie1, curie2 = futures[future]
+                result = {"curie1": curie1, "curie2": curie2}
+                try:
+                    result["conversation"] = future.result()
+                    result["status"] = "done"
+                except BudgetExhausted as e:
+                    result["status"] = "budget_exhausted"
+                    result["error"] = str(e)
+                except Exception as e:
+                    result["status"] = "failed"
+                    result["error"] = f"{type(e).__name__}: {e}"
+                results.append(result)
+                logger.info("pair finished", extra={"fields": {"done": done, "total": len(pairs), **result}})
+    finally:
+        shared.close()
+        cache.close()
+    logger.info("batch finished", extra={"fields": {"requests": budget.requests, "tokens": budget.tokens,
+                                                    **cache.stats()}})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Explore many curie pairs concurrently")
+    parser.add_argument("db")
+    parser.add_argument("pw")
+    parser.add_argument("pairs", help="csv or jsonl file of curie pairs")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=8, help="conversations running at once")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="LLM requests outstanding at once")
+    parser.add_argument("--max-requests", type=int, default=None, help="total LLM request budget")
+    parser.add_argument("--max-tokens", type=int, default=None, help="total LLM token budget")
+    parser.add_argument("--cache", default=None, help="sqlite file for query results shared between runs")
+    parser.add_argument("--prefetch", action="store_true", help="run likely next queries while waiting on the LLM")
+    parser.add_argument("--output", default=None, help="write per-pair results to this jsonl file")
+    args = parser.parse_args(argv)
+    configure_logging()
+    results = run_batch(args.db, args.pw, read_pairs(args.pairs), steps=args.steps, workers=args.workers,
+                        max_in_flight=args.max_in_flight, max_requests=args.max_requests, max_tokens=args.max_tokens,
+                        cache_path=args.cache, prefetch=args.prefetch)
+    if args.output is not None:
+        with open(args.output, "w") as outf:
+            for result in results:
+                outf.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
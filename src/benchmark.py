@@ -0,0 +1,256 @@
+import os, re, sys, json, time, random, tempfile, argparse, statistics, subprocess, contextlib
+import logging
+from graph_fixture import FixtureGraph, FixtureNeo4j, RecordingNeo4j, FIXTURE_SOURCE
+from SquirrelController import SquirrelController
+from conversation import BlackboardConversation
+from conversation_log import ConversationLog
+from examine_conversation import read_steps
+from llm_client import ChatClient
+from mock_llm import MockChatServer, chat_response
+from blackboard import count_tokens
+from knowledge_graph import is_partial
+
+def scripted_agent(request):
+    """Stand in for the model: read the blackboard out of the request and pick a plausible next action from it,
+    cycling through find_paths between the seeds, complete_edge on the smallest partial triple, expand_node on the
+    newest node and detail_edge on the newest few complete triples, and never repeating an action.  Those are the
+    choices that prefetching bets on, so with --prefetch this shows the best case."""
+    blackboard = json.loads(request["messages"][1]["content"])
+    done = set(json.dumps(action) for action in blackboard["previous_actions"])
+    kg = blackboard["knowledge graph"]
+    partials = sorted((t for t in kg if is_partial(t)),
+                      key=lambda t: t[2] if isinstance(t[2], int) else t[0])
+    completes = [t for t in reversed(kg) if not is_partial(t)]
+    candidates = [
+        [("find_paths", [])],
+        [("complete_edge", t) for t in partials],
+        [("expand_node", name) for t in completes for name in (t[0], t[2])],
+        [("detail_edge", completes[i:i + 3]) for i in range(0, len(completes), 3)],
+    ]
+    turn = len(blackboard["previous_actions"])
+    for i in range(len(candidates)):
+        for action, argument in candidates[(turn + i) % len(candidates)]:
+            if json.dumps([action, argument]) not in done:
+                content = {"new_observations": [f"Chose {action}"], "summary": f"Turn {turn}",
+                           "action": action, "argument": argument}
+                prompt = sum(count_tokens(message["content"]) for message in request["messages"])
+                return chat_response(json.dumps(content), prompt_tokens=prompt, completion_tokens=50)
+    raise Exception("Scripted agent ran out of actions")
+
+def median_ms(function, arguments):
+    times = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def benchmark_queries(neo4j, graph, samples, rng):
+    """Return the median milliseconds for each Neo4j operation, on the hub node and on random nodes."""
+    hub = neo4j.get_name(graph.hub())
+    nodes = [neo4j.get_name(graph.curies[rng.randrange(len(graph.curies))]) for _ in range(samples)]
+    hub_schema = neo4j.get_neighborhood_schema(hub)
+    biggest = max(hub_schema, key=lambda t: t[2] if isinstance(t[2], int) else t[0])
+    edges = [graph.edges[rng.randrange(len(graph.edges))] for _ in range(samples)]
+    triples = [(neo4j.get_name(graph.curies[s]), p, neo4j.get_name(graph.curies[o])) for s, p, o, _ in edges]
+    return {
+        "schema_hub_ms": median_ms(neo4j.get_neighborhood_schema, [hub] * samples),
+        "schema_random_ms": median_ms(neo4j.get_neighborhood_schema, nodes),
+        "edges_hub_all_ms": median_ms(neo4j.get_edges, [biggest] * samples),
+        "edges_hub_page_ms": median_ms(lambda e: neo4j.get_edge_page(e, limit=25), [biggest] * samples),
+        "detail_edge_ms": median_ms(neo4j.detail_edge, triples),
+        "detail_edges_ms": median_ms(neo4j.detail_edges, [triples]),
+        "find_paths_ms": median_ms(lambda node: neo4j.find_paths(hub, node), nodes),
+    }
+
+def benchmark_conversation(neo4j, graph, steps, responses, root, rng, prefetch=False, llm_delay=0):
+    """Run a conversation against the mock chat endpoint, which takes llm_delay seconds to answer, and return one row
+    of timings per step, with how many of the update's queries were answered by prefetching."""
+    curie1 = graph.hub()
+    curie2 = graph.curies[rng.randrange(len(graph.curies))]
+    controller = SquirrelController(None, None, curie1, curie2, neo4j=neo4j, prefetch=prefetch)
+    with MockChatServer(responses, delay=llm_delay) as server:
+        conversation = BlackboardConversation(controller, client=ChatClient("benchmark", url=server.url),
+                                              conversation_root=root)
+        conversation.iterate(steps)
+    rows = []
+    for record in ConversationLog(conversation.conversation_directory):
+        rows.append({"step": record["step"], "kg_size": len(record["state"]["kg"]),
+                     "prompt_tokens": record["response"]["usage"]["prompt_tokens"],
+                     "payload_ms": record["timing"]["payload"] * 1000,
+                     "update_ms": record["timing"]["update"] * 1000,
+                     "prefetches": sum(1 for span in record["spans"] if span["name"] == "neo4j.prefetch"),
+                     "cached_queries": sum(1 for span in record["spans"]
+                                           if span["name"] == "neo4j.query" and span.get("cached"))})
+    return rows
+
+# What a fresh interpreter runs for each entry point, followed by a report of which heavy dependencies it loaded
+STARTUP = {
+    "python": "pass",
+    "import controller": "import SquirrelController",
+    "new controller": "from SquirrelController import SquirrelController\n"
+                              "SquirrelController('localhost', 'pw', 'MONDO:0010778', 'PUBCHEM.COMPOUND:3776')",
+    "import batch": "import batch",
+    "cli --help": "import blindsquirrel\ntry:\n    blindsquirrel.main(['--help'])\nexcept SystemExit:\n    pass",
+    "import examine": "import examine_conversation",
+}
+HEAVY_MODULES = ["neo4j", "requests", "yaml", "tiktoken"]
+
+def benchmark_startup(samples):
+    """Return a row for each entry point with the median milliseconds for a fresh interpreter to run it (python is
+    the interpreter on its own) and the heavy dependencies that it loaded, which should be none of them."""
+    report = f"\nimport sys\nprint('loaded:', *[m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    directory = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for name, code in STARTUP.items():
+        times = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", code + report], cwd=directory, check=True,
+                                    capture_output=True, text=True).stdout
+            times.append((time.perf_counter() - start) * 1000)
+        loaded = output.splitlines()[-1].split()[1:]
+        rows.append({"entry_point": name, "startup_ms": statistics.median(times), "heavy_modules": " ".join(loaded)})
+    return rows
+
+def record_queries():
+    """Return every distinct (cypher, parameters) that Neo4j builds, by calling each of its query methods with each of
+    their options on a RecordingNeo4j."""
+    neo4j = RecordingNeo4j()
+    # With no rows, check_indexes would warn that there are no indexes
+    logging.getLogger("operations").setLevel(logging.ERROR)
+    # Looking up unregistered names and a disambiguated one records the name and curie lookups; the queries answer
+    # with no rows, so register the nodes that the other methods need by hand
+    neo4j.get_name("MONDO:0000001")
+    neo4j.resolve_names(["Unregistered", "Unregistered (MONDO:0000002)"])
+    neo4j.nodes.add("MONDO:0000001", "Alpha")
+    neo4j.nodes.add("CHEBI:0000002", "Beta")
+    try:
+        neo4j.get_graph_version()
+    except IndexError:
+        # It needs the row it didn't get, but the query has been recorded
+        pass
+    neo4j.check_indexes()
+    neo4j.get_neighborhood_schemas(["Alpha", "Beta"])
+    for edge in [("Alpha", "biolink:treats", 10), (10, "biolink:treats", "Beta")]:
+        for order_by in ["degree", "publications", None]:
+            for limit in [None, 25]:
+                neo4j.get_edge_page(edge, limit=limit, skip=25, order_by=order_by)
+    neo4j.detail_edges([("Alpha", "biolink:treats", "Beta"), ("Beta", "biolink:causes", "Alpha")])
+    for shortest in [True, False]:
+        for predicates in [None, "biolink:treats", ["biolink:treats", "biolink:causes"]]:
+            neo4j.find_paths("Alpha", "Beta", predicates=predicates, shortest=shortest)
+    queries = []
+    for cypher, parameters in neo4j.queries:
+        if (cypher, parameters) not in queries:
+            queries.append( (cypher, parameters) )
+    return queries
+
+def check_queries(queries, session=None):
+    """Return a list of the problems found in queries: parameters that are used but not passed, or passed but not
+    used, or of types that the driver can't send.  If session is given, each query is also run with EXPLAIN, which
+    has neo4j parse, type check and plan it without running it."""
+    sendable = (str, int, float, bool, type(None), list, dict)
+    problems = []
+    for cypher, parameters in queries:
+        used = set(re.findall(r"\$(\w+)", cypher))
+        for name in sorted(used - set(parameters)):
+            problems.append(f"${name} isn't passed: {cypher}")
+        for name in sorted(set(parameters) - used):
+            problems.append(f"{name} is passed but not used: {cypher}")
+        for name, value in parameters.items():
+            if not isinstance(value, sendable):
+                problems.append(f"{name} is a {type(value).__name__}: {cypher}")
+        if session is not None:
+            try:
+                session.run("EXPLAIN " + cypher, parameters).consume()
+            except Exception as e:
+                problems.append(f"{type(e).__name__}: {e}: {cypher}")
+    return problems
+
+def print_rows(rows):
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    print("  ".join(f"{column:>17}" for column in columns))
+    for row in rows:
+        print("  ".join(f"{row[c]:>17.3f}" if isinstance(row[c], float) else f"{row[c]:>17}" for c in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the hot paths on a synthetic graph with a mock LLM")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated node counts")
+    parser.add_argument("--edges-per-node", type=int, default=5)
+    parser.add_argument("--skew", type=float, default=1.0, help="higher means more of the edges go to a few hubs")
+    parser.add_argument("--steps", type=int, default=20, help="conversation length")
+    parser.add_argument("--samples", type=int, default=20, help="calls per query timing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--neo4j", nargs=2, metavar=("HOST", "PASSWORD"), default=None,
+                        help="use a local neo4j instead of the in-memory stand-in (only with a single size)")
+    parser.add_argument("--load", action="store_true", help="load the fixture into the (empty) --neo4j first")
+    parser.add_argument("--replay", default=None,
+                        help="replay the responses of this recorded conversation instead of the scripted agent; "
+                             "they only make sense against the graph they were recorded on")
+    parser.add_argument("--prefetch", action="store_true", help="prefetch likely next queries during the LLM call")
+    parser.add_argument("--query-ms", type=float, default=0,
+                        help="time the in-memory stand-in takes for each neighborhood or edge page query")
+    parser.add_argument("--llm-ms", type=float, default=0, help="time the mock LLM takes to answer")
+    parser.add_argument("--root", default=None,
+                        help="keep the conversations under this directory, instead of a temporary one removed at exit")
+    parser.add_argument("--check-queries", action="store_true",
+                        help="check every query that Neo4j builds instead, with EXPLAIN on --neo4j if it's given")
+    parser.add_argument("--startup", action="store_true",
+                        help="time how long each entry point takes to start instead, in a fresh interpreter")
+    args = parser.parse_args()
+    if args.startup:
+        print_rows(benchmark_startup(args.samples))
+        sys.exit()
+    if args.check_queries:
+        queries = record_queries()
+        if args.neo4j is not None:
+            from operations import Neo4j
+            checker = Neo4j(*args.neo4j)
+            problems = check_queries(queries, checker.get_session())
+            checker.close()
+        else:
+            problems = check_queries(queries)
+        for problem in problems:
+            print(problem)
+        print(f"{len(queries)} queries checked, {len(problems)} problems")
+        sys.exit(1 if problems else 0)
+
+    if args.root is not None:
+        os.makedirs(args.root, exist_ok=True)
+        workspace = contextlib.nullcontext(args.root)
+    else:
+        # Removed at exit, along with the conversation logs in it
+        workspace = tempfile.TemporaryDirectory(prefix="blindsquirrel-benchmark-")
+    with workspace as workdir:
+        # Keep detail_edge off the network
+        catalog_path = os.path.join(workdir, "infores.json")
+        with open(catalog_path, "w") as outf:
+            json.dump({FIXTURE_SOURCE: {"id": FIXTURE_SOURCE, "name": "Fixture", "description": "Synthetic edges"}}, outf)
+        os.environ["BLINDSQUIRREL_INFORES_CATALOG"] = catalog_path
+        responses = scripted_agent
+        if args.replay is not None:
+            responses = [step["response"] for step in read_steps(args.replay)]
+
+        for size in [int(size) for size in args.sizes.split(",")]:
+            rng = random.Random(args.seed)
+            start = time.perf_counter()
+            graph = FixtureGraph(size, edges_per_node=args.edges_per_node, skew=args.skew, seed=args.seed)
+            print(f"\n{size} nodes, {len(graph.edges)} edges, hub degree {graph.degree(graph.index[graph.hub()])} "
+                  f"(built in {time.perf_counter() - start:.1f}s)")
+            if args.neo4j is not None:
+                from operations import Neo4j
+                make_neo4j = lambda: Neo4j(*args.neo4j)
+                if args.load:
+                    loader = make_neo4j()
+                    graph.load_into_neo4j(loader.connect())
+                    loader.close()
+            else:
+                make_neo4j = lambda: FixtureNeo4j(graph, latency=args.query_ms / 1000)
+            neo4j = make_neo4j()
+            print_rows([benchmark_queries(neo4j, graph, args.samples, rng)])
+            neo4j.close()
+            print_rows(benchmark_conversation(make_neo4j(), graph, args.steps, responses, workdir, rng,
+                                              prefetch=args.prefetch, llm_delay=args.llm_ms / 1000))
@@ -0,0 +1,83 @@
+import json
+from knowledge_graph import is_partial
+
+# tiktoken is optional and slow to import, so it is loaded the first time tokens are counted; False if not installed
+tiktoken = None
+_encodings = {}
+
+def count_tokens(text, model="gpt-4"):
+    """Count the tokens in text with tiktoken if it's installed, and otherwise estimate about four characters a token."""
+    global tiktoken
+    if tiktoken is None:
+        try:
+            import tiktoken
+        except ImportError:
+            tiktoken = False
+    if tiktoken is False:
+        return len(text) // 4 + 1
+    if model not in _encodings:
+        _encodings[model] = tiktoken.encoding_for_model(model)
+    return len(_encodings[model].encode(text))
+
+def render(blackboard):
+    """Serialize a blackboard for the prompt, without the whitespace that json.dumps adds by default."""
+    return json.dumps(blackboard, separators=(",", ":"), ensure_ascii=False)
+
+def dedupe(items, key):
+    seen = set()
+    kept = []
+    for item in items:
+        k = key(item)
+        if k not in seen:
+            seen.add(k)
+            kept.append(item)
+    return kept
+
+def compact_blackboard(blackboard, token_budget, seeds=(), model="gpt-4"):
+    """Return a copy of blackboard that renders to no more than token_budget tokens (when that's possible).
+    1. Repeated observations and actions are removed, and actions are shortened to [action, argument] pairs.
+    2. If that isn't enough, things are dropped oldest first, in order of how little we lose by dropping them:
+       partial triples that don't touch a seed node, then observations, then previous actions, then complete triples
+       that don't touch a seed node.  The most recent observation and action are always kept.
+    3. Anything dropped is counted under "omitted" so that the model knows the blackboard has been trimmed.
+    """
+    observations = dedupe(blackboard["observations"], lambda o: " ".join(str(o).lower().split()))
+    actions = dedupe([[a["action"], a["argument"]] for a in blackboard["previous_actions"]], lambda a: render(a))
+    seeds = set(seeds)
+    compact = {
+        "knowledge graph": [list(triple) for triple in blackboard["knowledge graph"]],
+        "observations": observations,
+        "summary": blackboard["summary"],
+        "previous_actions": actions
+    }
+    excess = count_tokens(render(compact), model) - token_budget
+    if excess <= 0:
+        return compact
+    # An item costs about its own rendering plus a separator.  That's only an estimate, so after each pass we measure
+    # the whole blackboard again and go around until it fits or there is nothing left to drop.
+    cost = lambda item: count_tokens(render(item) + ",", model)
+    touches_seed = lambda triple: triple[0] in seeds or triple[2] in seeds
+    omitted = {}
+    compact["omitted"] = omitted
+    def drop(key, droppable, label, keep_last=0):
+        nonlocal excess
+        items = compact[key]
+        keep = []
+        for index, item in enumerate(items):
+            if excess > 0 and index < len(items) - keep_last and droppable(item):
+                excess -= cost(item)
+                omitted[label] = omitted.get(label, 0) + 1
+            else:
+                keep.append(item)
+        compact[key] = keep
+        return len(items) - len(keep)
+    passes = [
+        ("knowledge graph", lambda t: is_partial(t) and not touches_seed(t), "partial triples", 0),
+        ("observations", lambda o: True, "observations", 1),
+        ("previous_actions", lambda a: True, "previous_actions", 1),
+        ("knowledge graph", lambda t: not is_partial(t) and not touches_seed(t), "complete triples", 0),
+    ]
+    for key, droppable, label, keep_last in passes:
+        while excess > 0 and drop(key, droppable, label, keep_last) > 0:
+            excess = count_tokens(render(compact), model) - token_budget
+    return compact
@@ -1,6 +1,10 @@
-import sys
-import yaml, requests
+import os, sys, argparse, importlib
+import logging
 from operations import Neo4j
+from infores import get_infores_catalog
+from tracing import configure_logging
+
+logger = logging.getLogger(__name__)
 
 class Squirrel:
     def __init__(self, db, pw, curie1, curie2):
@@ -24,7 +28,7 @@ class Squirrel:
         ignorable_properties = ["biolink:primary_knowledge_source", "predicate", "knowledge_source", "subject", "biolink:aggregator_knowledge_source",
                                 "id", "object"]
         edge_properties = self.neo4j.detail_edge(edge)
-        print(edge_properties[0])
+        logger.debug("edge properties", extra={"fields": edge_properties[0]})
         usable_properties = self.generate_source_text(edge_properties[0]["biolink:primary_knowledge_source"])
         for property in edge_properties[0]:
             if property in ignorable_properties:
@@ -35,7 +39,7 @@ class Squirrel:
                 elif property in ["object_direction_qualifier", "object_aspect_qualifier", "qualified_predicate", "subject_direction_qualifier", "subject_aspect_qualifier"]:
                     usable_properties[property] = edge_properties[0][property]
                 else:
-                    print(property, edge_properties[0][property])
+                    logger.debug("unused edge property", extra={"fields": {property: edge_properties[0][property]}})
         return usable_properties
 
     def generate_source_text(self, source):
@@ -44,13 +48,10 @@ class Squirrel:
         return { "source name": self.infores_catalog[source]["name"], "source description": self.infores_catalog[source]["description"]}
 
     def pull_infores_catalog(self):
-        url = "https://raw.githubusercontent.com/biolink/biolink-model/master/infores_catalog.yaml"
-        direct_yaml =  yaml.load(requests.get(url).text, Loader=yaml.FullLoader)
-        self.infores_catalog = {infores["id"]:infores for infores in direct_yaml["information_resources"]}
+        self.infores_catalog = get_infores_catalog()
 
     def generate_initial_chat_prompt(self):
-        self.kg = self.get_neighborhood_schema(self.name1)
-        self.kg += self.get_neighborhood_schema(self.name2)
+        self.kg = self.neo4j.get_neighborhood_schemas([self.name1, self.name2])
         prompt = \
 f""" You are a translational researcher exploring the relationship between {self.name1} and {self.name2}.   
 The tool at your disposal is a large knowledge graph (KG).  This KG is composed of many (subject, relationship, object) triples.    
@@ -86,65 +87,57 @@ Knowledge Graph:
 
         return prompt
 
-if __name__ == "__main__":
-    # get the db and pw from the command line
-    db = sys.argv[1]
-    pw = sys.argv[2]
-    # create the blind squirrel
-    curie1 = "MONDO:0010778"  # Cyclic Vomiting Syndrome
-    curie2 = "PUBCHEM.COMPOUND:3776"  # isopropyl alcohol
-    squirrel = Squirrel(db, pw, curie1, curie2)
-
-    # generate the initial chat prompt
-    #prompt = squirrel.generate_initial_chat_prompt()
-    #print(prompt)
-
-    # Complete edge on CVS has phenotype:
-    #new_edges = squirrel.get_edges( ('cyclic vomiting syndrome', 'biolink:has_phenotype', 24) )
-    #for edge in new_edges:
-    #   print(edge)
-
-    #Complete edge on Isopropyl Alcohol causes_adverse_event
-    #new_edges = squirrel.get_edges( ('Isopropyl Alcohol', 'biolink:has_adverse_event', 164) )
-    #for edge in new_edges:
-    #    print(edge)
-
-    #detail edge:
-    #squirrel.neo4j.name_to_curie['Abdominal Pain'] = "HP:0002027"
-    #details = squirrel.detail_edge( ('Isopropyl Alcohol', 'biolink:has_adverse_event', 'Abdominal Pain') )
-    #for k,v in details.items():
-    #   print(f"{k}: {v}")
-
-    # Complete edge on CVS causes:
-    #new_edges = squirrel.get_edges(('cyclic vomiting syndrome', 'biolink:causes', 1))
-    #for edge in new_edges:
-    #   print(edge)
-
-    # detail edge:
-    #squirrel.neo4j.name_to_curie['TRNL1'] = "NCBIGene:4567"
-    #details = squirrel.detail_edge( ('cyclic vomiting syndrome', 'biolink:causes', 'TRNL1') )
-    #for k,v in details.items():
-    #    print(f"{k}: {v}")
-
-    # Complete Edge
-    #new_edges = squirrel.get_edges( ('Isopropyl Alcohol', 'biolink:treats', 20) )
-    #for edge in new_edges:
-    #   print(edge)
-
-    # detail edge:
-    #squirrel.neo4j.name_to_curie['Nausea and vomiting'] = "HP:0002017"
-    #details = squirrel.detail_edge( ('Isopropyl Alcohol', 'biolink:treats', 'Nausea and vomiting') )
-    #for k,v in details.items():
-    #    print(f"{k}: {v}")
-
-    # Complete Edge
-    #new_edges = squirrel.get_edges( ('Isopropyl Alcohol', 'biolink:affects', 70) )
-    #for edge in new_edges:
-    #   print(edge)
-
-    # detail edge:
-    new_edges = squirrel.get_edges( ('Isopropyl Alcohol', 'biolink:affects', 70) ) # gets adh1a mapping
-    details = squirrel.detail_edge(('Isopropyl Alcohol', 'biolink:affects', 'ADH1A') )
-    for k,v in details.items():
-        print(f"{k}: {v}")
+# Subcommands that are handed to another module's main with the rest of the command line
+FORWARDED = {"batch": "batch", "examine": "examine_conversation"}
+
+def main(argv=None):
+    """The blindsquirrel command line: run or resume one exploration, or hand off to batch or examine.
+    Only the modules that the chosen command needs are imported, so that --help and examine start quickly."""
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 0 and argv[0] in FORWARDED:
+        return importlib.import_module(FORWARDED[argv[0]]).main(argv[1:])
+    parser = argparse.ArgumentParser(prog="blindsquirrel", description="Explore the relationship between two nodes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="start a new exploration")
+    resume = commands.add_parser("resume", help="continue a saved exploration")
+    for command in (run, resume):
+        command.add_argument("db")
+        command.add_argument("pw")
+        if command is resume:
+            command.add_argument("conversation", help="id of the conversation to resume")
+        # The pair we have been studying; for resume, only used by conversations saved before the state was
+        command.add_argument("--curie1", default="MONDO:0010778", help="default: Cyclic Vomiting Syndrome")
+        command.add_argument("--curie2", default="PUBCHEM.COMPOUND:3776", help="default: isopropyl alcohol")
+        command.add_argument("--steps", type=int, default=20)
+        command.add_argument("--root", default="conversations", help="directory the conversations are saved under")
+        command.add_argument("--cache", default=os.environ.get("BLINDSQUIRREL_QUERY_CACHE"),
+                             help="sqlite file for query results shared between runs")
+        command.add_argument("--prefetch", action="store_true", help="run likely next queries while waiting on the LLM")
+    commands.add_parser("batch", help="explore many pairs concurrently (see batch --help)")
+    commands.add_parser("examine", help="report on saved conversations (see examine --help)")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    from SquirrelController import SquirrelController
+    from conversation import BlackboardConversation
+    from query_cache import QueryCache
+    cache = QueryCache(path=args.cache)
+    if args.command == "resume":
+        state, step = BlackboardConversation.load_state(os.path.join(args.root, args.conversation),
+                                                        curie1=args.curie1, curie2=args.curie2)
+        squirrel = SquirrelController(args.db, args.pw, state["curie1"], state["curie2"], cache=cache, state=state,
+                                      prefetch=args.prefetch)
+        conversation = BlackboardConversation(squirrel, conversation_identifier=args.conversation,
+                                              conversation_root=args.root)
+    else:
+        squirrel = SquirrelController(args.db, args.pw, args.curie1, args.curie2, cache=cache, prefetch=args.prefetch)
+        conversation = BlackboardConversation(squirrel, conversation_root=args.root)
+    try:
+        conversation.iterate(args.steps)
+    finally:
+        squirrel.neo4j.close()
+        logger.info("query cache", extra={"fields": cache.stats()})
+        cache.close()
 
+if __name__ == "__main__":
+    main()
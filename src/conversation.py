@@ -1,55 +1,113 @@
-import uuid,os
-import requests
+import uuid,os,re
 import json
-import time
+import logging
+from llm_client import ChatClient
+from conversation_log import ConversationLog
+from tracing import total_seconds
+
+logger = logging.getLogger(__name__)
 
 class BlackboardConversation():
     """A conversation with an OpenAI chat completion model.  Instead of always passing the entire previous
     conversation as the prompt, we maintain a blackboard of information that we have learned and use that to
     create the prompt.  One component of the blackboard is a knowledge graph that has been extracted from ROBOKOP KG.
-    The requests and responses are serialized so that they are easily viewed/parsed, and also so that we can pick back
-    up after running for several iterations."""
-    def __init__(self, controller):
-        self.api_key = os.environ.get("OPENAI_API_KEY")
-        self.create_serialization("conversations")
+    The responses and blackboard states are serialized to a ConversationLog so that they are easily viewed/parsed, and
+    also so that we can pick back up after running for several iterations."""
+    def __init__(self, controller, client=None, conversation_identifier=None, conversation_root="conversations"):
+        """To resume a conversation, pass its identifier along with a controller restored from load_state.  New steps
+        are numbered on from the last one that was saved."""
+        if client is None:
+            client = ChatClient(os.environ.get("OPENAI_API_KEY"))
+        self.client = client
+        self.create_serialization(conversation_root, conversation_identifier)
         self.controller = controller
 
-    def create_serialization(self, conversation_directory):
-        # Create a unique identifier for this conversation
-        self.conversation_identifier = str(uuid.uuid4())
-        # Create a directory for this conversation
-        self.conversation_directory = os.path.join(conversation_directory, self.conversation_identifier)
-        os.mkdir(self.conversation_directory)
+    def create_serialization(self, conversation_directory, conversation_identifier=None):
+        if conversation_identifier is None:
+            # Create a unique identifier for this conversation
+            self.conversation_identifier = str(uuid.uuid4())
+            # Create a directory for this conversation
+            self.conversation_directory = os.path.join(conversation_directory, self.conversation_identifier)
+            os.mkdir(self.conversation_directory)
+        else:
+            self.conversation_identifier = conversation_identifier
+            self.conversation_directory = os.path.join(conversation_directory, self.conversation_identifier)
+        self.log = ConversationLog(self.conversation_directory, writable=True)
+        if len(self.log) > 0:
+            self.next_step = self.log.read_record(len(self.log) - 1)["step"] + 1
+        else:
+            # Conversations from before the log was introduced have one file per step
+            steps = self.saved_steps(self.conversation_directory)
+            self.next_step = steps[-1] + 1 if steps else 0
+
+    @staticmethod
+    def saved_steps(conversation_directory):
+        """Return the numbers of the steps saved as separate step_N.json files in conversation_directory, in order."""
+        steps = []
+        for filename in os.listdir(conversation_directory):
+            match = re.fullmatch(r"step_(\d+)\.json", filename)
+            if match is not None:
+                steps.append(int(match.group(1)))
+        return sorted(steps)
+
+    @staticmethod
+    def load_state(conversation_directory, curie1=None, curie2=None):
+        """Return (controller state, step number) from the last step saved in conversation_directory.
+        Step files saved before the controller state was serialized only have the blackboard; for those, curie1 and
+        curie2 must be given, and names are looked up again as they are needed."""
+        if ConversationLog.exists(conversation_directory):
+            log = ConversationLog(conversation_directory)
+            if len(log) > 0:
+                return log.state_at(len(log) - 1), log.read_record(len(log) - 1)["step"]
+        steps = BlackboardConversation.saved_steps(conversation_directory)
+        if len(steps) == 0:
+            raise Exception(f"No saved steps in {conversation_directory}")
+        with open(os.path.join(conversation_directory, f"step_{steps[-1]}.json"), "r") as inf:
+            saved = json.load(inf)
+        if "state" in saved:
+            return saved["state"], steps[-1]
+        if curie1 is None or curie2 is None:
+            raise Exception(f"Step {steps[-1]} has no controller state; the seed curies are needed to resume it")
+        blackboard = saved["blackboard"]
+        state = {
+            "curie1": curie1,
+            "curie2": curie2,
+            "kg": blackboard["knowledge graph"],
+            "observations": blackboard["observations"],
+            "summary": blackboard["summary"],
+            "actions": blackboard["previous_actions"]
+        }
+        return state, steps[-1]
 
     def iterate(self, steps=1):
-        for step in range(steps):
-            print(f"Step {step}")
-            payload = self.controller.generate_payload()
-            response = self.execute(payload)
-            content = json.loads( response["choices"][0]["message"]["content"] )
-            self.controller.update(content)
+        for step in range(self.next_step, self.next_step + steps):
+            logger.info("step", extra={"fields": {"conversation": self.conversation_identifier, "step": step}})
+            with self.controller.tracer.span("conversation.step", step=step):
+                payload = self.controller.generate_payload()
+                # Let the database work on likely next queries while we wait for the LLM
+                self.controller.prefetch()
+                response = self.execute(payload)
+                content = json.loads( response["choices"][0]["message"]["content"] )
+                self.controller.update(content)
             self.serialize(payload, response, step)
-            #sleep for 60 seconds to avoid rate limiting
-            print ('  ...zzz')
-            time.sleep(60)
-            print( "  ...awake")
+            self.next_step = step + 1
 
     def execute(self, payload):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        # Todo: build in some resiliency here
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        if response.status_code != 200:
-            print(response.text)
-            raise Exception("OpenAI API call failed")
-        jsonresponse = response.json()
+        # The client handles rate limiting, retries and timeouts
+        with self.controller.tracer.span("llm.execute", model=payload["model"]) as span:
+            jsonresponse = self.client.complete(payload)
+            span.update(jsonresponse.get("usage", {}))
         finish_reason = jsonresponse["choices"][0]["finish_reason"]
         if not finish_reason == "stop":
             raise Exception(f"OpenAI API call failed. finish_reason = {finish_reason}")
         return jsonresponse
 
     def serialize(self, payload, response, step):
-        with open(os.path.join(self.conversation_directory, f"step_{step}.json"), "w") as out:
-            json.dump({"payload": payload, "response": response, "blackboard": self.controller.generate_blackboard()}, out, indent=4)
\ No newline at end of file
+        spans = self.controller.tracer.drain()
+        timing = {"payload": total_seconds(spans, "controller.generate_payload"),
+                  "llm": total_seconds(spans, "llm.execute"),
+                  "update": total_seconds(spans, "controller.update")}
+        logger.info("step done", extra={"fields": {"conversation": self.conversation_identifier, "step": step, **timing}})
+        # The blackboard and the rest of the payload can be rebuilt from the state, so only the model is kept
+        self.log.append({"step": step, "model": payload["model"], "response": response, "timing": timing,
+                         "spans": spans}, self.controller.get_state())
@@ -0,0 +1,182 @@
+import os, json, gzip
+
+def normalize(value):
+    """Round trip through json, so that tuples become lists and comparisons match what we read back."""
+    return json.loads(json.dumps(value))
+
+def item_key(item):
+    return json.dumps(item, sort_keys=True)
+
+def apply_list_delta(before, delta):
+    if "append" in delta:
+        return before + delta["append"]
+    removed = set(item_key(item) for item in delta["remove"])
+    return [item for item in before if item_key(item) not in removed] + delta["add"]
+
+def diff_state(before, after):
+    """Return a delta that turns state before into state after.  Lists that only grew store what was appended,
+    lists that changed in the middle (like the KG) store what was removed and what was added, and anything else
+    that changed is stored whole."""
+    delta = {}
+    for key, value in after.items():
+        old = before.get(key)
+        if value == old:
+            continue
+        if isinstance(value, list) and isinstance(old, list):
+            if value[:len(old)] == old:
+                delta[key] = {"append": value[len(old):]}
+                continue
+            new_keys = set(item_key(item) for item in value)
+            old_keys = set(item_key(item) for item in old)
+            list_delta = {"remove": [item for item in old if item_key(item) not in new_keys],
+                          "add": [item for item in value if item_key(item) not in old_keys]}
+            # Removing and adding only reproduces the list if the surviving items kept their order
+            if apply_list_delta(old, list_delta) == value:
+                delta[key] = list_delta
+                continue
+        delta[key] = {"set": value}
+    return delta
+
+def apply_delta(state, delta):
+    state = dict(state)
+    for key, change in delta.items():
+        if "set" in change:
+            state[key] = change["set"]
+        else:
+            state[key] = apply_list_delta(state.get(key, []), change)
+    return state
+
+class ConversationLog:
+    """An append-only, compressed log of the steps of one conversation.
+    steps.jsonl.gz holds one gzip member per step, each a single json record, so the whole file can be streamed with
+    gzip.open.  steps.idx has the byte offset and length of each member, for random access to any step.
+    Each record has the step's response and either a full snapshot of the controller state (every snapshot_every
+    steps) or the delta from the previous step's state, so the KG isn't written out again at every step.
+    Records are looked up by their step number with get and state, and by their position in the log with read_record
+    and state_at.  A conversation resumed from older step_N.json files starts its log after its last step file, so
+    the two only match for conversations that were logged from the start.
+    Only the conversation that is running opens its log with writable set.  Readers, which may look at a log while it
+    is being appended to, see the steps that were indexed when they opened it and never change the files."""
+    def __init__(self, directory, snapshot_every=10, writable=False):
+        self.data_path = os.path.join(directory, "steps.jsonl.gz")
+        self.index_path = os.path.join(directory, "steps.idx")
+        self.snapshot_every = snapshot_every
+        self.writable = writable
+        self.index = self.read_index()
+        self.last_state = None
+        self.first_step = None
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, "steps.idx"))
+
+    def read_index(self):
+        index = []
+        if not os.path.exists(self.index_path):
+            return index
+        complete = True
+        with open(self.index_path, "r") as inf:
+            for line in inf:
+                parts = line.split()
+                if len(parts) == 2 and line.endswith("\n"):
+                    index.append( (int(parts[0]), int(parts[1])) )
+                else:
+                    complete = False
+        # Anything after the last complete index line is either being appended right now or was left by a crash.
+        # Readers just ignore it; only the writer, which is the one that would have been appending, repairs it.
+        if not self.writable:
+            return index
+        # A crash while appending can leave a partial last line, which has to go before we append after it
+        if not complete:
+            with open(self.index_path, "w") as outf:
+                for offset, length in index:
+                    outf.write(f"{offset} {length}\n")
+        # And a crash between writing the data and the index can leave an unindexed record on the end of the data
+        end = index[-1][0] + index[-1][1] if index else 0
+        if os.path.exists(self.data_path) and os.path.getsize(self.data_path) > end:
+            with open(self.data_path, "r+b") as data:
+                data.truncate(end)
+        return index
+
+    def append(self, record, state):
+        """Add a step.  record is anything json-serializable; state is the controller state after the step."""
+        if not self.writable:
+            raise ValueError("ConversationLog was opened read only")
+        state = normalize(state)
+        record = dict(record)
+        if len(self.index) % self.snapshot_every == 0:
+            record["snapshot"] = state
+        else:
+            record["delta"] = diff_state(self.state_at(len(self.index) - 1), state)
+        member = gzip.compress((json.dumps(record) + "\n").encode("utf-8"))
+        with open(self.data_path, "ab") as data:
+            offset = data.tell()
+            data.write(member)
+            data.flush()
+            os.fsync(data.fileno())
+        with open(self.index_path, "a") as index:
+            index.write(f"{offset} {len(member)}\n")
+        self.index.append( (offset, len(member)) )
+        self.last_state = (len(self.index) - 1, state)
+
+    def read_record(self, position):
+        """Return the raw record at position in the log, without reconstructing its state."""
+        offset, length = self.index[position]
+        with open(self.data_path, "rb") as data:
+            data.seek(offset)
+            return json.loads(gzip.decompress(data.read(length)))
+
+    def position(self, step):
+        """Return the position in the log of the record for step.  Steps are logged one after another, so this is
+        counted from the first step in the log.  Raises KeyError if step isn't in the log."""
+        if len(self.index) > 0 and self.first_step is None:
+            self.first_step = self.read_record(0)["step"]
+        position = step - self.first_step if self.first_step is not None else -1
+        if not 0 <= position < len(self.index) or self.read_record(position)["step"] != step:
+            raise KeyError(f"No step {step} in the log")
+        return position
+
+    def state(self, step):
+        """Return the controller state after step."""
+        return self.state_at(self.position(step))
+
+    def state_at(self, position):
+        """Return the controller state after the record at position, from the nearest snapshot at or before it plus
+        the deltas since."""
+        if self.last_state is not None and self.last_state[0] == position:
+            return self.last_state[1]
+        deltas = []
+        record = self.read_record(position)
+        while "snapshot" not in record:
+            deltas.append(record["delta"])
+            position -= 1
+            record = self.read_record(position)
+        state = record["snapshot"]
+        for delta in reversed(deltas):
+            state = apply_delta(state, delta)
+        return state
+
+    def get(self, step):
+        """Return the record for step with its full state under "state"."""
+        position = self.position(step)
+        record = self.read_record(position)
+        record["state"] = self.state_at(position)
+        return record
+
+    def __iter__(self):
+        """Stream every record in order, with its full state under "state"."""
+        state = None
+        # Read member by member rather than with gzip.open, which would read ahead into a record that isn't indexed yet
+        with open(self.data_path, "rb") as data:
+            for offset, length in self.index:
+                data.seek(offset)
+                record = json.loads(gzip.decompress(data.read(length)))
+                if "snapshot" in record:
+                    state = record["snapshot"]
+                else:
+                    state = apply_delta(state, record["delta"])
+                record["state"] = state
+                yield record
+
+    def __len__(self):
+        return len(self.index)
@@ -1,17 +1,158 @@
+import os, sys, csv
 import json
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from conversation_log import ConversationLog
+from conversation import BlackboardConversation
+from knowledge_graph import is_partial
 
-conversation_id = "815907e6-9a76-4da8-ab4e-cf35fa9c8ef6"
-
-for i in range(14):
-    with open(f"conversations/{conversation_id}/step_{i}.json", "r") as f:
-        step = json.load(f)
-
-    print(f"Step {i}")
-    content = json.loads(step["response"]["choices"][0]["message"]["content"])
-    print("New Observation Count", len(content["new_observations"]))
-    print("Next Operation", content["action"])
-    print("Next Argument", content["argument"])
-    print("Input Tokens", step["response"]["usage"]["prompt_tokens"])
-    print("Output Tokens", step["response"]["usage"]["completion_tokens"])
-    print("Totalput Tokens", step["response"]["usage"]["total_tokens"])
-    print("")
+# Dollars per 1000 (prompt, completion) tokens.  Models are matched by prefix, longest first, so "gpt-4-0613" is gpt-4.
+PRICES = {
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+COLUMNS = ["conversation", "step", "model", "prompt_tokens", "completion_tokens", "cost", "kg_size", "kg_partial",
+           "new_observations", "action", "argument", "repeated", "payload_s", "llm_s", "update_s", "neo4j_s", "neo4j_queries",
+           "cached_queries", "db_ms"]
+
+def read_steps(conversation_directory):
+    """Stream the step records of a conversation in order: first those in the step files of an older conversation,
+    then those in its log.  A conversation started before the log and resumed since has both."""
+    for i in BlackboardConversation.saved_steps(conversation_directory):
+        with open(os.path.join(conversation_directory, f"step_{i}.json"), "r") as f:
+            step = json.load(f)
+        step["step"] = i
+        yield step
+    if ConversationLog.exists(conversation_directory):
+        yield from ConversationLog(conversation_directory)
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    for prefix in sorted(PRICES, key=len, reverse=True):
+        if model.startswith(prefix):
+            prompt_price, completion_price = PRICES[prefix]
+            return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+    return None
+
+def analyze_conversation(conversation_directory):
+    """Return one row (a dict with the keys in COLUMNS) for each step of the conversation."""
+    conversation = os.path.basename(os.path.normpath(conversation_directory))
+    rows = []
+    seen_actions = set()
+    for step in read_steps(conversation_directory):
+        response = step["response"]
+        usage = response.get("usage", {})
+        content = json.loads(response["choices"][0]["message"]["content"])
+        if "state" in step:
+            kg = step["state"]["kg"]
+        else:
+            kg = step["blackboard"]["knowledge graph"]
+        model = step.get("model") or response.get("model", "")
+        action = (content.get("action"), json.dumps(content.get("argument")))
+        timing = step.get("timing") or {}
+        queries = [span for span in step.get("spans", []) if span["name"] == "neo4j.query"]
+        observations = content.get("new_observations", [])
+        rows.append({
+            "conversation": conversation,
+            "step": step["step"],
+            "model": model,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "cost": estimate_cost(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)),
+            "kg_size": len(kg),
+            "kg_partial": sum(1 for triple in kg if is_partial(triple)),
+            "new_observations": len(observations) if isinstance(observations, list) else 1,
+            "action": action[0],
+            "argument": action[1],
+            "repeated": action in seen_actions,
+            "payload_s": timing.get("payload"),
+            "llm_s": timing.get("llm"),
+            "update_s": timing.get("update"),
+            # Time spent waiting on the queries themselves, as opposed to the whole update, which also includes
+            # loading the infores catalog and updating the KG.  Steps saved before spans were recorded have none.
+            "neo4j_s": sum(span["seconds"] for span in queries) if "spans" in step else None,
+            "neo4j_queries": len(queries),
+            "cached_queries": sum(1 for span in queries if span.get("cached")),
+            # The server's own time to plan, run and stream each query, as opposed to the round trip
+            "db_ms": sum(span.get("db_available_ms", 0) + span.get("db_consumed_ms", 0) for span in queries),
+        })
+        seen_actions.add(action)
+    return rows
+
+def summarize(rows):
+    """Aggregate step rows into one summary row per conversation plus an "ALL" row."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(row["conversation"], []).append(row)
+    groups["ALL"] = rows
+    summaries = []
+    for conversation, group in groups.items():
+        total = lambda column: sum(row[column] or 0 for row in group)
+        timed = [row for row in group if row["llm_s"] is not None]
+        traced = [row for row in group if row["neo4j_s"] is not None]
+        actions = Counter(row["action"] for row in group)
+        summaries.append({
+            "conversation": conversation,
+            "steps": len(group),
+            "prompt_tokens": total("prompt_tokens"),
+            "completion_tokens": total("completion_tokens"),
+            "cost": round(total("cost"), 4),
+            "final_kg_size": max((row["kg_size"] for row in group), default=0),
+            "repeated": sum(1 for row in group if row["repeated"]),
+            "actions": " ".join(f"{action}={count}" for action, count in actions.most_common()),
+            "llm_s": round(sum(row["llm_s"] for row in timed), 2) if timed else None,
+            "update_s": round(sum(row["update_s"] for row in timed), 2) if timed else None,
+            "neo4j_s": round(sum(row["neo4j_s"] for row in traced), 2) if traced else None,
+            "neo4j_queries": total("neo4j_queries"),
+            "db_ms": total("db_ms"),
+        })
+    return summaries
+
+def print_table(rows, columns):
+    cells = [[str(column) for column in columns]]
+    for row in rows:
+        cells.append(["" if row[column] is None else
+                      f"{row[column]:.4f}" if isinstance(row[column], float) else str(row[column])
+                      for column in columns])
+    widths = [min(40, max(len(cell[i]) for cell in cells)) for i in range(len(columns))]
+    for cell in cells:
+        print("  ".join(value[:width].ljust(width) for value, width in zip(cell, widths)))
+
+def write_csv(rows, columns, out):
+    writer = csv.DictWriter(out, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({column: row[column] for column in columns})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report token use, cost, KG growth, actions and timing per step")
+    parser.add_argument("conversations", nargs="*", help="conversation ids (default: everything under --root)")
+    parser.add_argument("--root", default="conversations")
+    parser.add_argument("--steps", action="store_true", help="report every step instead of one row per conversation")
+    parser.add_argument("--csv", default=None, help="write csv to this file ('-' for stdout) instead of a table")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    conversation_ids = args.conversations or sorted(os.listdir(args.root))
+    directories = [os.path.join(args.root, c) for c in conversation_ids if os.path.isdir(os.path.join(args.root, c))]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        rows = [row for conversation_rows in executor.map(analyze_conversation, directories)
+                for row in conversation_rows]
+    if args.steps:
+        report, columns = rows, COLUMNS
+    else:
+        report = summarize(rows)
+        columns = list(report[0].keys())
+    if args.csv == "-":
+        write_csv(report, columns, sys.stdout)
+    elif args.csv is not None:
+        with open(args.csv, "w", newline="") as out:
+            write_csv(report, columns, out)
+    else:
+        print_table(report, columns)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import time, random
+from collections import Counter
+from operations import Neo4j, NODE_LABEL, EDGE_DETAIL_PROPERTIES, rel_type, predicate_list
+from node_registry import DISAMBIGUATED_NAME
+from tracing import traced
+
+CATEGORIES = [
+    ("biolink:Disease", "MONDO"),
+    ("biolink:SmallMolecule", "PUBCHEM.COMPOUND"),
+    ("biolink:Gene", "NCBIGene"),
+    ("biolink:PhenotypicFeature", "HP"),
+]
+PREDICATES = ["biolink:treats", "biolink:affects", "biolink:has_phenotype", "biolink:causes",
+              "biolink:has_adverse_event", "biolink:related_to", "biolink:interacts_with"]
+FIXTURE_SOURCE = "infores:fixture"
+
+class FixtureGraph:
+    """A synthetic biolink-style graph for benchmarking without a real KG.
+    Edge endpoints are drawn with weight 1/(rank+1)**skew, so with skew around 1 a few hub nodes end up with most of
+    the edges, as the common phenotypes and chemicals do in ROBOKOP.  A fraction duplicate_names of the nodes reuse
+    an earlier node's name, to exercise the name disambiguation."""
+    def __init__(self, node_count=1000, edges_per_node=5, skew=1.0, duplicate_names=0.01, seed=0):
+        rng = random.Random(seed)
+        self.curies = []
+        self.names = []
+        self.categories = []
+        for i in range(node_count):
+            category, prefix = CATEGORIES[i % len(CATEGORIES)]
+            self.curies.append(f"{prefix}:{i}")
+            if i > 0 and rng.random() < duplicate_names:
+                self.names.append(self.names[rng.randrange(i)])
+            else:
+                self.names.append(f"{category.split(':')[1]} {i}")
+            self.categories.append(category)
+        self.index = {curie: i for i, curie in enumerate(self.curies)}
+        self.by_name = {}
+        for i, name in enumerate(self.names):
+            self.by_name.setdefault(name, []).append(i)
+        weights = [1.0 / (rank + 1) ** skew for rank in range(node_count)]
+        # Shuffle which nodes are the hubs, so that hubs aren't all in one category
+        order = list(range(node_count))
+        rng.shuffle(order)
+        edge_count = node_count * edges_per_node
+        subjects = rng.choices(order, weights=weights, k=edge_count)
+        objects = rng.choices(order, weights=weights, k=edge_count)
+        self.edges = []
+        self.outgoing = [[] for _ in range(node_count)]
+        self.incoming = [[] for _ in range(node_count)]
+        for subject, object in zip(subjects, objects):
+            if subject == object:
+                continue
+            properties = {"biolink:primary_knowledge_source": FIXTURE_SOURCE,
+                          "publications": [f"PMID:{rng.randrange(10**7)}" for _ in range(rng.randrange(4))]}
+            if rng.random() < 0.2:
+                properties["FAERS_llr"] = round(rng.uniform(0, 50), 2)
+            edge_id = len(self.edges)
+            self.edges.append( (subject, rng.choice(PREDICATES), object, properties) )
+            self.outgoing[subject].append(edge_id)
+            self.incoming[object].append(edge_id)
+
+    def degree(self, node):
+        return len(self.outgoing[node]) + len(self.incoming[node])
+
+    def hub(self):
+        """Return the curie of the node with the most edges."""
+        return self.curies[max(range(len(self.curies)), key=self.degree)]
+
+    def load_into_neo4j(self, driver, batch_size=10000):
+        """Write the graph into an empty neo4j, with the same label and id index that ROBOKOP has, and an index on name."""
+        with driver.session() as session:
+            if session.run("MATCH (n) RETURN count(n) AS c").single()["c"] != 0:
+                raise Exception("Refusing to load the fixture into a neo4j that already has nodes in it")
+            session.run(f"CREATE INDEX fixture_id IF NOT EXISTS FOR (n:`{NODE_LABEL}`) ON (n.id)")
+            session.run(f"CREATE INDEX fixture_name IF NOT EXISTS FOR (n:`{NODE_LABEL}`) ON (n.name)")
+            nodes = [{"id": curie, "name": name} for curie, name in zip(self.curies, self.names)]
+            for start in range(0, len(nodes), batch_size):
+                session.run(f"UNWIND $nodes AS node CREATE (n:`{NODE_LABEL}`) SET n = node",
+                            nodes=nodes[start:start + batch_size])
+            by_predicate = {}
+            for subject, predicate, object, properties in self.edges:
+                by_predicate.setdefault(predicate, []).append(
+                    {"s": self.curies[subject], "o": self.curies[object], "p": properties})
+            for predicate, edges in by_predicate.items():
+                for start in range(0, len(edges), batch_size):
+                    session.run(f"UNWIND $edges AS edge "
+                                f"MATCH (a:`{NODE_LABEL}` {{id: edge.s}}), (b:`{NODE_LABEL}` {{id: edge.o}}) "
+                                f"CREATE (a)-[r:{rel_type(predicate)}]->(b) SET r = edge.p",
+                                edges=edges[start:start + batch_size])
+
+class FixtureNeo4j(Neo4j):
+    """An in-memory stand-in for Neo4j that answers from a FixtureGraph, so the controller can't tell the difference.
+    The neighborhood and edge page queries are answered record by record in place of the cypher, so that Neo4j's own
+    paging, query cache and prefetching run on top of them as they would against the database; the other lookups are
+    overridden whole.  Each of those queries takes at least latency seconds, to stand in for the round trip."""
+    def __init__(self, graph, tracer=None, cache=None, latency=0):
+        super().__init__(None, None, cache=cache, tracer=tracer)
+        self.graph = graph
+        self.latency = latency
+
+    def get_graph_version(self):
+        return f"fixture:{len(self.graph.curies)}:{len(self.graph.edges)}"
+
+    def read_uncached(self, cypher, **parameters):
+        with self.tracer.span("neo4j.query", cached=False) as span:
+            records = self.read_in_new_session(cypher, parameters)
+            span["rows"] = len(records)
+        return records
+
+    def read_in_new_session(self, cypher, parameters):
+        time.sleep(self.latency)
+        if cypher == "fixture neighborhood":
+            return self.neighborhood_records(**parameters)
+        return self.edge_page_records(**parameters)
+
+    def neighborhood_query(self, curies):
+        return "fixture neighborhood", {"curies": curies}
+
+    def neighborhood_records(self, curies):
+        records = []
+        for curie in curies:
+            node = self.graph.index[curie]
+            for forward, edge_ids in ((True, self.graph.outgoing[node]), (False, self.graph.incoming[node])):
+                counts = Counter(self.graph.edges[edge_id][1] for edge_id in edge_ids)
+                records += [{"curie": curie, "forward": forward, "r": predicate, "c": count}
+                            for predicate, count in counts.items()]
+        return records
+
+    def edge_page_query(self, edge, curie, limit, skip, order_by):
+        if order_by not in ("degree", "publications", None):
+            raise ValueError(f"Invalid order_by: {order_by}")
+        parameters = {"curie": curie, "predicate": edge[1], "forward": isinstance(edge[2], int),
+                      "order_by": order_by, "skip": skip}
+        if limit is not None:
+            parameters["limit"] = limit + 1
+        return "fixture edge page", parameters
+
+    def edge_page_records(self, curie, predicate, forward, order_by, skip, limit=None):
+        node = self.graph.index[curie]
+        others = []
+        for edge_id in self.graph.outgoing[node] if forward else self.graph.incoming[node]:
+            subject, edge_predicate, object, properties = self.graph.edges[edge_id]
+            if edge_predicate != predicate:
+                continue
+            other = object if forward else subject
+            if order_by == "degree":
+                score = self.graph.degree(other)
+            elif order_by == "publications":
+                score = len(properties.get("publications", []))
+            else:
+                score = 0
+            others.append( (-score, self.graph.curies[other], other) )
+        others.sort()
+        page = others[skip:] if limit is None else others[skip:skip + limit]
+        return [{"id": curie, "n": self.graph.names[other]} for _, curie, other in page]
+
+    @traced("neo4j.get_name")
+    def get_name(self, curie):
+        name = self.nodes.name(curie)
+        if name is not None:
+            return name
+        node = self.graph.index.get(curie)
+        if node is not None:
+            return self.nodes.add(curie, self.graph.names[node])
+
+    @traced("neo4j.resolve_names")
+    def resolve_names(self, names):
+        found = []
+        for name in self.nodes.missing(names):
+            match = DISAMBIGUATED_NAME.match(name)
+            if match is not None:
+                nodes = [self.graph.index[match.group(2)]] if match.group(2) in self.graph.index else []
+            else:
+                nodes = self.graph.by_name.get(name, [])
+            found += [(self.graph.names[node], self.graph.curies[node]) for node in nodes]
+        for name, curie in sorted(set(found)):
+            self.nodes.add(curie, name)
+
+    @traced("neo4j.detail_edges")
+    def detail_edges(self, edges):
+        self.resolve_names([name for edge in edges for name in (edge[0], edge[2])])
+        details = []
+        for edge in edges:
+            subject = self.graph.index[self.get_curie(edge[0])]
+            object = self.graph.index[self.get_curie(edge[2])]
+            details.append([{key: properties[key] for key in EDGE_DETAIL_PROPERTIES if key in properties}
+                            for _, predicate, other, properties in
+                            (self.graph.edges[edge_id] for edge_id in self.graph.outgoing[subject])
+                            if predicate == edge[1] and other == object])
+        return details
+
+    @traced("neo4j.find_paths")
+    def find_paths(self, name1, name2, max_length=3, limit=10, predicates=None, shortest=True):
+        self.resolve_names([name1, name2])
+        start = self.graph.index[self.get_curie(name1)]
+        end = self.graph.index[self.get_curie(name2)]
+        if start == end:
+            return []
+        predicates = set(predicate_list(predicates))
+        def neighbors(node):
+            for edge_id in self.graph.outgoing[node] + self.graph.incoming[node]:
+                subject, predicate, object, _ = self.graph.edges[edge_id]
+                if not predicates or predicate in predicates:
+                    yield edge_id, object if subject == node else subject
+        # Breadth first distances back from the end, so that the search below only follows edges that can still
+        # reach the end within the length it is looking for
+        distance = {end: 0}
+        frontier = [end]
+        for depth in range(1, max_length):
+            next_frontier = []
+            for node in frontier:
+                for _, other in neighbors(node):
+                    if other not in distance:
+                        distance[other] = depth
+                        next_frontier.append(other)
+            frontier = next_frontier
+        # Depth first search for simple paths, shortest first, stopping after the shortest length when shortest is set
+        found = []
+        for length in range(1, max_length + 1):
+            stack = [(start, [], {start})]
+            while stack:
+                node, path, visited = stack.pop()
+                if node == end:
+                    found.append(path)
+                    continue
+                remaining = length - len(path) - 1
+                for edge_id, other in neighbors(node):
+                    if other not in visited and distance.get(other, max_length) <= remaining \
+                            and (other != end or remaining == 0):
+                        stack.append((other, path + [edge_id], visited | {other}))
+            if found and shortest:
+                break
+        found.sort(key=lambda path: (len(path), path))
+        paths = []
+        for path in found[:limit]:
+            triples = []
+            for edge_id in path:
+                subject, predicate, object, _ = self.graph.edges[edge_id]
+                triples.append( (self.nodes.add(self.graph.curies[subject], self.graph.names[subject]), predicate,
+                                 self.nodes.add(self.graph.curies[object], self.graph.names[object])) )
+            paths.append(triples)
+        return paths
+
+class RecordingNeo4j(Neo4j):
+    """A Neo4j that records each query it would run, as (cypher, parameters), instead of running it, and answers
+    every one with no rows.  Unlike FixtureNeo4j it builds all of its queries with the real code, so the recorded
+    queries can be checked without a database (see benchmark.py --check-queries)."""
+    def __init__(self, tracer=None):
+        super().__init__(None, None, tracer=tracer)
+        self.queries = []
+
+    def read_uncached(self, cypher, **parameters):
+        self.queries.append( (cypher, parameters) )
+        return []
+
+    def read_in_new_session(self, cypher, parameters):
+        return self.read_uncached(cypher, **parameters)
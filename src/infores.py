@@ -0,0 +1,79 @@
+import os, json, time, threading
+
+INFORES_URL = "https://raw.githubusercontent.com/biolink/biolink-model/master/infores_catalog.yaml"
+CACHE_DIRECTORY = os.environ.get("BLINDSQUIRREL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "blindsquirrel"))
+# How long a cached catalog is used before we ask github whether it has changed
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# The catalog is shared by every controller in the process
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_infores_catalog():
+    """Return the infores catalog as a dict from infores id to catalog entry, loading it the first time it's asked for.
+    If BLINDSQUIRREL_INFORES_CATALOG is set, it is read from that path (yaml or json) and the network is never used."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            override = os.environ.get("BLINDSQUIRREL_INFORES_CATALOG")
+            if override:
+                _catalog = read_catalog_file(override)
+            else:
+                _catalog = load_cached_catalog(os.path.join(CACHE_DIRECTORY, "infores_catalog.json"))
+        return _catalog
+
+def read_catalog_file(path):
+    with open(path, "r") as inf:
+        if path.endswith(".json"):
+            return json.load(inf)
+        return parse_catalog(inf.read())
+
+def parse_catalog(text):
+    # yaml and requests are only imported when the catalog isn't cached, to keep them out of startup
+    import yaml
+    # The C loader is an order of magnitude faster on a file this size, but isn't in every pyyaml build
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    direct_yaml = yaml.load(text, Loader=loader)
+    return {infores["id"]: infores for infores in direct_yaml["information_resources"]}
+
+def load_cached_catalog(cache_path, url=INFORES_URL, ttl=CACHE_TTL):
+    """Return the catalog from the json cache at cache_path, going to the network only when needed.
+    1. If the cache is younger than ttl, use it as is.
+    2. Otherwise, revalidate against url with the cached ETag.  A 304 just refreshes the cache timestamp.
+    3. If the catalog changed (or there was no cache), parse the new yaml and rewrite the cache.
+    4. If the network is unavailable, fall back to a stale cache rather than failing.
+    """
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as inf:
+            cached = json.load(inf)
+        if time.time() - cached["fetched"] < ttl:
+            return cached["catalog"]
+    import requests
+    headers = {}
+    if cached is not None and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    try:
+        response = requests.get(url, headers=headers, timeout=60)
+    except requests.RequestException:
+        if cached is None:
+            raise
+        return cached["catalog"]
+    if response.status_code == 304:
+        cached["fetched"] = time.time()
+    elif response.status_code == 200:
+        cached = {"etag": response.headers.get("ETag"), "fetched": time.time(), "catalog": parse_catalog(response.text)}
+    elif cached is not None:
+        return cached["catalog"]
+    else:
+        raise Exception(f"Unable to download infores catalog. status_code = {response.status_code}")
+    write_cache(cache_path, cached)
+    return cached["catalog"]
+
+def write_cache(cache_path, cached):
+    # Write to a temporary file and swap it in, so that a concurrent reader never sees half a cache
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as outf:
+        json.dump(cached, outf)
+    os.replace(temp_path, cache_path)
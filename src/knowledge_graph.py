@@ -0,0 +1,134 @@
+def is_partial(triple):
+    """Whether triple is a partial triple, (node, predicate, count) or (count, predicate, node): exactly one end is a
+    count and the other two terms are strings."""
+    if not isinstance(triple, (list, tuple)) or len(triple) != 3:
+        return False
+    def is_count(term):
+        return isinstance(term, int) and not isinstance(term, bool)
+    if is_count(triple[2]):
+        return isinstance(triple[0], str) and isinstance(triple[1], str)
+    if is_count(triple[0]):
+        return isinstance(triple[1], str) and isinstance(triple[2], str)
+    return False
+
+def is_complete(triple):
+    """Whether triple is a complete (node, predicate, node) triple: exactly three terms, all strings."""
+    return isinstance(triple, (list, tuple)) and len(triple) == 3 and all(isinstance(term, str) for term in triple)
+
+class KnowledgeGraph:
+    """The knowledge graph on the blackboard.  It holds both complete (name, predicate, name) triples and partial
+    (name, predicate, count) / (count, predicate, name) triples.
+    Every term is interned to an integer id, and each triple is stored once as a tuple of ids.  Triples are kept in
+    insertion order, and are indexed by each of their terms so that adding, removing, testing membership and finding
+    the partial triple for a (node, predicate, direction) are all constant time.
+    There is at most one partial triple for each (node, predicate, direction); adding another replaces it."""
+    def __init__(self, triples=()):
+        self.terms = []
+        self.term_ids = {}
+        # A dict rather than a set, so that iteration follows insertion order.  Values are unused.
+        self.triples = {}
+        # (position, term id) -> {triple key: None}
+        self.index = {}
+        # (node id, predicate id, is_forward) -> triple key
+        self.partials = {}
+        self.extend(triples)
+
+    def intern(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = len(self.terms)
+            self.terms.append(term)
+            self.term_ids[term] = term_id
+        return term_id
+
+    def key(self, triple):
+        """Return the tuple of ids for triple, or None if any of its terms have never been seen."""
+        try:
+            return tuple(self.term_ids[term] for term in triple)
+        except KeyError:
+            return None
+
+    def partial_key(self, triple):
+        if not is_partial(triple):
+            return None
+        if isinstance(triple[2], int):
+            return self.term_ids[triple[0]], self.term_ids[triple[1]], True
+        return self.term_ids[triple[2]], self.term_ids[triple[1]], False
+
+    def add(self, triple):
+        """Add triple to the graph, replacing any partial triple for the same node, predicate and direction.
+        Return False if it was already there."""
+        key = tuple(self.intern(term) for term in triple)
+        if key in self.triples:
+            return False
+        partial_key = self.partial_key(triple)
+        if partial_key is not None:
+            replaced = self.partials.get(partial_key)
+            if replaced is not None:
+                self.remove(self.triple(replaced))
+            self.partials[partial_key] = key
+        self.triples[key] = None
+        for position, term_id in enumerate(key):
+            self.index.setdefault((position, term_id), {})[key] = None
+        return True
+
+    def extend(self, triples):
+        for triple in triples:
+            self.add(triple)
+
+    def remove(self, triple):
+        """Remove triple from the graph, raising ValueError if it isn't there (the same as list.remove)"""
+        key = self.key(triple)
+        if key is None or key not in self.triples:
+            raise ValueError(f"{triple} is not in the knowledge graph")
+        del self.triples[key]
+        for position, term_id in enumerate(key):
+            del self.index[(position, term_id)][key]
+        partial_key = self.partial_key(triple)
+        if partial_key is not None and self.partials.get(partial_key) == key:
+            del self.partials[partial_key]
+
+    def partial(self, node, predicate, forward=True):
+        """Return the partial triple (node, predicate, count) if forward, else (count, predicate, node), or None."""
+        key = self.key((node, predicate))
+        if key is None:
+            return None
+        triple_key = self.partials.get(key + (forward,))
+        if triple_key is None:
+            return None
+        return self.triple(triple_key)
+
+    def match(self, subject=None, predicate=None, object=None):
+        """Return the triples with the given terms, in insertion order.  Terms that are None match anything."""
+        candidates = None
+        for position, term in enumerate((subject, predicate, object)):
+            if term is None:
+                continue
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                return []
+            keys = self.index.get((position, term_id), {})
+            if candidates is None or len(keys) < len(candidates):
+                candidates = keys
+        if candidates is None:
+            return list(self)
+        return [self.triple(key) for key in candidates
+                if all(term is None or self.terms[term_id] == term
+                       for term, term_id in zip((subject, predicate, object), key))]
+
+    def triple(self, key):
+        return tuple(self.terms[term_id] for term_id in key)
+
+    def to_list(self):
+        return list(self)
+
+    def __contains__(self, triple):
+        key = self.key(triple)
+        return key is not None and key in self.triples
+
+    def __iter__(self):
+        for key in self.triples:
+            yield self.triple(key)
+
+    def __len__(self):
+        return len(self.triples)
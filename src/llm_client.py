@@ -0,0 +1,155 @@
+import re, time, random, threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def parse_duration(value):
+    """Turn an OpenAI rate limit reset value such as "20ms", "1s" or "6m0.5s" into seconds.  None if unparseable."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    found = False
+    for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value):
+        found = True
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds if found else None
+
+class BudgetExhausted(Exception):
+    pass
+
+class RequestBudget:
+    """A cap on the total number of requests sent and tokens used, shared by every client that is given it.
+    None means no cap."""
+    def __init__(self, max_requests=None, max_tokens=None):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.requests = 0
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Count a request against the budget, raising BudgetExhausted if there is nothing left."""
+        with self.lock:
+            if self.max_requests is not None and self.requests >= self.max_requests:
+                raise BudgetExhausted(f"Request budget of {self.max_requests} used up")
+            if self.max_tokens is not None and self.tokens >= self.max_tokens:
+                raise BudgetExhausted(f"Token budget of {self.max_tokens} used up")
+            self.requests += 1
+
+    def exhausted(self):
+        with self.lock:
+            return (self.max_requests is not None and self.requests >= self.max_requests) or \
+                   (self.max_tokens is not None and self.tokens >= self.max_tokens)
+
+    def record(self, usage):
+        with self.lock:
+            self.tokens += usage.get("total_tokens", 0)
+
+class ChatClient:
+    """Sends chat completion requests with a pooled HTTP session, request timeouts, and retries.
+    Rather than sleeping a fixed time between calls, it paces itself from the rate limit headers on each response:
+    when the remaining request or token quota runs out, the next request waits until the server says it resets.
+    429s and 5xx responses are retried with exponential backoff and full jitter, honoring Retry-After when present.
+    A single client may be shared by several threads, in which case they share the pacing, the optional budget, and
+    the cap of max_in_flight requests outstanding at once."""
+    def __init__(self, api_key, url=OPENAI_URL, timeout=(10, 300), max_retries=6, base_delay=1.0, max_delay=120.0,
+                 pool_size=10, max_in_flight=None, budget=None):
+        self.api_key = api_key
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # requests takes a noticeable part of a second to import, so it waits until a client is made
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.lock = threading.Lock()
+        # time.monotonic() before which no request should be sent
+        self.not_before = 0.0
+        # Rough size of the last request, used to decide whether the remaining token quota covers the next one
+        self.last_request_tokens = 0
+        self.budget = budget
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+
+    def complete(self, payload):
+        """POST payload to the chat endpoint and return the decoded json response."""
+        import requests
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_quota()
+            if self.budget is not None:
+                self.budget.reserve()
+            try:
+                response = self.post(headers, payload)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                self.defer(self.backoff(attempt))
+                continue
+            self.update_quota(response)
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                logger.error("chat completion failed", extra={"fields": {"status": response.status_code,
+                                                                          "body": response.text}})
+                raise Exception(f"OpenAI API call failed. status_code = {response.status_code}")
+            retry_after = parse_duration(response.headers.get("retry-after"))
+            logger.info("retrying chat completion", extra={"fields": {"status": response.status_code,
+                                                                      "attempt": attempt, "retry_after": retry_after}})
+            self.defer(retry_after if retry_after is not None else self.backoff(attempt))
+
+    def post(self, headers, payload):
+        if self.in_flight is None:
+            return self.session.post(self.url, headers=headers, json=payload, timeout=self.timeout)
+        with self.in_flight:
+            return self.session.post(self.url, headers=headers, json=payload, timeout=self.timeout)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def defer(self, seconds):
+        """Hold off all requests on this client for at least seconds."""
+        with self.lock:
+            self.not_before = max(self.not_before, time.monotonic() + seconds)
+
+    def wait_for_quota(self):
+        while True:
+            with self.lock:
+                delay = self.not_before - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def update_quota(self, response):
+        """Read the x-ratelimit-* headers, and if the quota is spent, hold off until it resets."""
+        headers = response.headers
+        usage = None
+        if response.status_code == 200:
+            usage = response.json().get("usage")
+        if usage is not None:
+            self.last_request_tokens = usage.get("total_tokens", 0)
+            if self.budget is not None:
+                self.budget.record(usage)
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None and int(remaining_requests) <= 0:
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset is not None:
+                self.defer(reset)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and int(remaining_tokens) < self.last_request_tokens:
+            reset = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+            if reset is not None:
+                self.defer(reset)
@@ -0,0 +1,155 @@
+import json, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def chat_response(content, prompt_tokens=0, completion_tokens=0, model="gpt-4"):
+    """Wrap content in the same json that the chat completions endpoint returns."""
+    return {
+        "object": "chat.completion",
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+class MockChatServer:
+    """A local stand-in for the chat completions endpoint, for exercising ChatClient and BlackboardConversation
+    without the OpenAI API.  It answers with the given responses in order (repeating the last one when it runs out),
+    or, if responses is a function, with whatever it returns when called with the decoded request.
+    If rate_limit_every is set, every rate_limit_every-th request is refused with a 429 and a Retry-After header.
+    If fail_with is set, every request is answered with that status instead.  quota_headers replaces the
+    x-ratelimit-* headers sent with each successful response, which by default never run out."""
+    def __init__(self, responses, port=0, rate_limit_every=None, retry_after=1, delay=0, fail_with=None,
+                 quota_headers=None):
+        self.responses = responses
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        # Seconds to wait before answering, to stand in for the model thinking
+        self.delay = delay
+        self.fail_with = fail_with
+        self.quota_headers = quota_headers if quota_headers is not None else \
+            {"x-ratelimit-remaining-requests": "100", "x-ratelimit-reset-requests": "1s"}
+        self.requests = []
+        # time.monotonic() when each request arrived
+        self.times = []
+        self.lock = threading.Lock()
+        self.served = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1/chat/completions"
+
+    def handler(self):
+        mock = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with mock.lock:
+                    mock.requests.append(body)
+                    mock.times.append(time.monotonic())
+                    count = len(mock.requests)
+                    if mock.fail_with is not None:
+                        response = None
+                    elif mock.rate_limit_every is None or count % mock.rate_limit_every != 0:
+                        if callable(mock.responses):
+                            response = mock.responses(body)
+                        else:
+                            response = mock.responses[min(mock.served, len(mock.responses) - 1)]
+                        mock.served += 1
+                    else:
+                        response = None
+                if mock.fail_with is not None:
+                    self.send(mock.fail_with, {"error": {"message": "Failed"}}, {})
+                    return
+                if response is None:
+                    self.send(429, {"error": {"message": "Rate limit reached"}}, {"Retry-After": str(mock.retry_after)})
+                    return
+                time.sleep(mock.delay)
+                self.send(200, response, mock.quota_headers)
+
+            def send(self, status, body, headers):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+def check_chat_client():
+    """Check ChatClient's retries, pacing and budget against the mock server, raising AssertionError on a failure."""
+    from llm_client import ChatClient, RequestBudget, BudgetExhausted
+    payload = {"model": "gpt-4", "messages": []}
+    responses = [chat_response(json.dumps({"step": i}), prompt_tokens=10, completion_tokens=5) for i in range(3)]
+
+    # A 429 is retried, after the Retry-After rather than the (much shorter) backoff
+    with MockChatServer(responses, rate_limit_every=2, retry_after=0.5) as server:
+        client = ChatClient("not-a-key", url=server.url, base_delay=0.01)
+        contents = [client.complete(payload)["choices"][0]["message"]["content"] for _ in range(2)]
+        assert contents == [json.dumps({"step": 0}), json.dumps({"step": 1})], contents
+        assert len(server.requests) == 3 and server.served == 2, (len(server.requests), server.served)
+        assert server.times[2] - server.times[1] >= 0.45, server.times
+
+    # When the request quota runs out, the next request waits for it to reset
+    quota = {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "500ms"}
+    with MockChatServer(responses, quota_headers=quota) as server:
+        client = ChatClient("not-a-key", url=server.url)
+        client.complete(payload)
+        client.complete(payload)
+        assert server.times[1] - server.times[0] >= 0.45, server.times
+
+    # A status that isn't worth retrying fails at once, and a retryable one fails after max_retries retries
+    with MockChatServer(responses, fail_with=400) as server:
+        client = ChatClient("not-a-key", url=server.url, base_delay=0.01)
+        try:
+            client.complete(payload)
+            assert False, "a 400 should raise"
+        except Exception as e:
+            assert "status_code = 400" in str(e), e
+        assert len(server.requests) == 1, len(server.requests)
+    with MockChatServer(responses, fail_with=503) as server:
+        client = ChatClient("not-a-key", url=server.url, max_retries=2, base_delay=0.01)
+        try:
+            client.complete(payload)
+            assert False, "a 503 should raise once the retries are used up"
+        except Exception as e:
+            assert "status_code = 503" in str(e), e
+        assert len(server.requests) == 3, len(server.requests)
+
+    # A budget stops requests once its requests, or its tokens, are used up, without sending anything more
+    for budget, allowed in [(RequestBudget(max_requests=2), 2), (RequestBudget(max_tokens=20), 2)]:
+        with MockChatServer(responses) as server:
+            client = ChatClient("not-a-key", url=server.url, budget=budget)
+            for _ in range(allowed):
+                client.complete(payload)
+            try:
+                client.complete(payload)
+                assert False, "the budget should be exhausted"
+            except BudgetExhausted:
+                pass
+            assert len(server.requests) == allowed and budget.exhausted(), len(server.requests)
+
+if __name__ == "__main__":
+    check_chat_client()
+    print("ChatClient checks passed")
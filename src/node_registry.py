@@ -0,0 +1,66 @@
+import re
+
+# A disambiguated display name, e.g. "ADH1A (NCBIGene:124)"
+DISAMBIGUATED_NAME = re.compile(r"^(.*) \(([^()\s]+:[^()\s]+)\)$")
+
+class NodeRegistry:
+    """A bidirectional map between node curies and the names that we show the LLM on the blackboard.
+    Each node is stored once, as an integer id into parallel lists of curies and names.
+    Names are not unique in the KG, but the names on the blackboard have to be.  The first node registered under a
+    name keeps it as is, and any other node with that name is shown as "name (curie)"."""
+    def __init__(self):
+        self.curies = []
+        self.names = []
+        self.curie_ids = {}
+        self.name_ids = {}
+
+    def add(self, curie, name):
+        """Register the node and return the name that should be used for it on the blackboard."""
+        node_id = self.curie_ids.get(curie)
+        if node_id is not None:
+            return self.names[node_id]
+        if name is None:
+            name = curie
+        if name in self.name_ids:
+            name = f"{name} ({curie})"
+        node_id = len(self.curies)
+        self.curies.append(curie)
+        self.names.append(name)
+        self.curie_ids[curie] = node_id
+        self.name_ids[name] = node_id
+        return name
+
+    def curie(self, name):
+        """Return the curie for a blackboard name, or None if we don't know it.  Anything that isn't a string, such as
+        the count from a partial triple, is never a name."""
+        if not isinstance(name, str):
+            return None
+        node_id = self.name_ids.get(name)
+        if node_id is None:
+            match = DISAMBIGUATED_NAME.match(name)
+            if match is not None:
+                node_id = self.curie_ids.get(match.group(2))
+        if node_id is None:
+            return None
+        return self.curies[node_id]
+
+    def name(self, curie):
+        node_id = self.curie_ids.get(curie)
+        if node_id is None:
+            return None
+        return self.names[node_id]
+
+    def missing(self, names):
+        """Return the names that can't be turned into curies yet, without duplicates.  Things that aren't strings are
+        left out, since no lookup would find them."""
+        return list(dict.fromkeys(name for name in names if isinstance(name, str) and self.curie(name) is None))
+
+    def entries(self):
+        """Return [ (curie, name), ...] in registration order.  Adding these to an empty registry recreates it."""
+        return list(zip(self.curies, self.names))
+
+    def __contains__(self, name):
+        return self.curie(name) is not None
+
+    def __len__(self):
+        return len(self.curies)
@@ -1,81 +1,438 @@
-from neo4j import GraphDatabase
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from node_registry import NodeRegistry, DISAMBIGUATED_NAME
+from tracing import Tracer, traced
+
+logger = logging.getLogger(__name__)
+
+# Every node in the ROBOKOP KG carries this label, and the id index/constraint is defined on it.  Scoping the
+# lookups to the label lets the planner use the index instead of scanning every node.
+NODE_LABEL = "biolink:NamedThing"
+
+# The edge properties that detail_edges returns.  The rest either repeat what the blackboard already says (subject,
+# predicate, object) or aren't used, and some edges carry a lot of them.
+QUALIFIERS = ["qualified_predicate", "object_aspect_qualifier", "object_direction_qualifier",
+              "subject_aspect_qualifier", "subject_direction_qualifier"]
+EDGE_DETAIL_PROPERTIES = ["biolink:primary_knowledge_source", "biolink:aggregator_knowledge_source", "publications",
+                          "FAERS_llr"] + QUALIFIERS
+
+def rel_type(predicate):
+    """Relationship types can't be passed as query parameters, so quote them for interpolation instead."""
+    return "`" + predicate.replace("`", "``") + "`"
+
+def predicate_list(predicates):
+    """Normalize predicates, which may be None, a single predicate, or a (possibly nested) list of them, into a list.
+    An empty list means any predicate.  Raises ValueError for anything else, such as a number."""
+    if predicates is None:
+        return []
+    if isinstance(predicates, str):
+        return [predicates]
+    if not isinstance(predicates, (list, tuple)):
+        raise ValueError(f"Not a predicate: {predicates!r}")
+    return [predicate for item in predicates for predicate in predicate_list(item)]
+
+class UnknownNode(KeyError):
+    """Raised for a name that isn't in the registry or the neo4j, usually one that the LLM got slightly wrong."""
 
 class Neo4j:
 
-    def __init__(self,db,pw):
-        self.driver = self.get_driver(db,pw)
-        self.name_to_curie = {}
+    def __init__(self,db,pw,driver=None,cache=None,tracer=None):
+        """If driver is given, this shares it (and its connection pool) instead of opening a new one.  Each Neo4j still
+        has its own session and node registry, so use one per controller and keep each one on a single thread.
+        If cache (a QueryCache) is given, read queries are answered from it when possible.  It may be shared too.
+        Every method call and query is recorded as a span on tracer.
+        Nothing is connected or queried here; that waits for the first query (see connect)."""
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.session = None
+        # Background reads started by prefetch_read, by cache key
+        self.prefetcher = None
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.nodes = NodeRegistry()
+        self.cache = cache
+        self.db = db
+        self.pw = pw
+        self.owns_driver = driver is None
+        self.driver = driver
+        # Whether the neo4j has an index on name, found by check_indexes; None until then, or when the driver is shared
+        self.name_index = None
 
     def get_driver(self, db, pw):
+        # The driver takes a noticeable part of a second to import, so it waits until we connect
+        from neo4j import GraphDatabase
         return GraphDatabase.driver(f'bolt://{db}:7687', auth=('neo4j', pw))
 
+    def connect(self):
+        """Return the driver, opening it (and checking for the indexes) the first time it is needed."""
+        if self.driver is None:
+            self.driver = self.get_driver(self.db, self.pw)
+            self.check_indexes()
+        return self.driver
+
+    def get_session(self):
+        """Return the session shared by every query in this run, opening it the first time it is needed."""
+        # Connect first: connecting checks the index, which itself needs the session
+        driver = self.connect()
+        if self.session is None:
+            from neo4j import READ_ACCESS
+            self.session = driver.session(default_access_mode=READ_ACCESS)
+        return self.session
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=True, cancel_futures=True)
+            self.prefetcher = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.owns_driver and self.driver is not None:
+            self.driver.close()
+            self.driver = None
+
+    def read(self, cypher, **parameters):
+        """Return the records for a parameterized query as a list of dicts, from the cache if we have one and it
+        knows the answer, and otherwise from the neo4j."""
+        if self.cache is None:
+            return self.read_uncached(cypher, **parameters)
+        key = self.cache_key(cypher, parameters)
+        with self.pending_lock:
+            future = self.pending.get(key)
+        if future is not None:
+            # The same query is already running in the background, so wait for it rather than running it twice
+            with self.tracer.span("neo4j.prefetch_wait"):
+                future.result()
+        results = self.cache.get(key)
+        if results is None:
+            results = self.read_uncached(cypher, **parameters)
+            self.cache.put(key, results)
+        else:
+            with self.tracer.span("neo4j.query", cached=True) as span:
+                span["rows"] = len(results)
+        return results
+
+    def cache_key(self, cypher, parameters):
+        if self.cache.graph_version is None:
+            # The first query through the cache finds out which graph snapshot it is caching
+            self.cache.graph_version = self.get_graph_version()
+        return self.cache.key(cypher, parameters)
+
+    def read_uncached(self, cypher, **parameters):
+        """Run a parameterized query in an explicit read transaction on the shared session and return the records.
+        The span for the query has the number of rows and the server's own timings from the result summary."""
+        def work(tx):
+            result = tx.run(cypher, parameters)
+            records = [record.data() for record in result]
+            return records, result.consume()
+        with self.tracer.span("neo4j.query", cached=False) as span:
+            records, summary = self.get_session().execute_read(work)
+            span["rows"] = len(records)
+            span["db_available_ms"] = summary.result_available_after
+            span["db_consumed_ms"] = summary.result_consumed_after
+        return records
+
+    def prefetch_read(self, cypher, **parameters):
+        """Start running a read in the background, on its own session, so that its result is already in the cache
+        when read asks for it.  Does nothing without a cache, or if the query is already cached or running."""
+        if self.cache is None:
+            return
+        key = self.cache_key(cypher, parameters)
+        with self.pending_lock:
+            if key in self.pending or self.cache.contains(key):
+                return
+            if self.prefetcher is None:
+                self.prefetcher = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+            self.pending[key] = self.prefetcher.submit(self.run_prefetch, key, cypher, parameters)
+
+    def run_prefetch(self, key, cypher, parameters):
+        try:
+            with self.tracer.span("neo4j.prefetch") as span:
+                records = self.read_in_new_session(cypher, parameters)
+                span["rows"] = len(records)
+            self.cache.put(key, records)
+        except Exception:
+            # A failed guess costs nothing; the foreground read will run the query itself
+            logger.exception("prefetch failed")
+        finally:
+            with self.pending_lock:
+                del self.pending[key]
+
+    def read_in_new_session(self, cypher, parameters):
+        """Run a read on a session of its own, for threads other than the one that uses the shared session."""
+        from neo4j import READ_ACCESS
+        with self.connect().session(default_access_mode=READ_ACCESS) as session:
+            return session.execute_read(lambda tx: [record.data() for record in tx.run(cypher, parameters)])
+
+    def get_graph_version(self):
+        """Identify the graph snapshot by its node and relationship counts, which neo4j keeps without a scan."""
+        result = self.read_uncached("CALL { MATCH (n) RETURN count(n) AS nodes } "
+                                    "CALL { MATCH ()-[r]->() RETURN count(r) AS edges } "
+                                    "RETURN nodes, edges")[0]
+        return f"{result['nodes']}:{result['edges']}"
+
+    def check_indexes(self):
+        """Make sure that there are indexes (or constraints) on id and name for NODE_LABEL.  Without the id index,
+        every lookup below turns into a scan of the whole graph.  Names are only looked up when they aren't in the
+        registry (resuming a conversation saved without its nodes, or a name that the LLM got wrong), but without the
+        name index each of those is a scan too."""
+        indexes = self.read_uncached("SHOW INDEXES YIELD labelsOrTypes, properties "
+                                     "WHERE $label IN labelsOrTypes RETURN properties", label=NODE_LABEL)
+        indexed = set(tuple(index['properties']) for index in indexes)
+        self.name_index = ("name",) in indexed
+        if not self.name_index:
+            logger.warning(f"No index on :`{NODE_LABEL}`(name); looking up an unregistered name will scan the "
+                           f"whole graph")
+        if ("id",) not in indexed:
+            logger.warning(f"No index on :`{NODE_LABEL}`(id); node lookups will scan the whole graph")
+            return False
+        return self.name_index
+
+    @traced("neo4j.get_name")
     def get_name(self, curie):
         """Given a curie, return the name of the node in the neo4j.
         1. Query the neo4j to return the name of the node.
-        2. Put the curie and name of the node into name_to_curie
-        3. Return the name
+        2. Register the curie and name of the node in nodes
+        3. Return the (possibly disambiguated) name
         """
-        with self.driver.session() as session:
-            results = session.run(f'MATCH (a) WHERE a.id = "{curie}" RETURN a.name as n')
-            for result in results:
-                self.name_to_curie[result['n']] = curie
-                return result['n']
+        name = self.nodes.name(curie)
+        if name is not None:
+            return name
+        results = self.read(f'MATCH (a:`{NODE_LABEL}` {{id: $curie}}) RETURN a.name as n', curie=curie)
+        for result in results:
+            return self.nodes.add(curie, result['n'])
+
+    @traced("neo4j.resolve_names")
+    def resolve_names(self, names):
+        """Make sure that every name in names is registered in nodes, looking up all of the missing ones in one query.
+        Disambiguated names ("name (curie)") are looked up by their curie, and the rest by name.  When several nodes
+        share a name, they are registered in curie order so that the same one always gets the plain name.
+        """
+        missing = self.nodes.missing(names)
+        if len(missing) == 0:
+            return
+        by_curie = []
+        by_name = []
+        for name in missing:
+            match = DISAMBIGUATED_NAME.match(name)
+            if match is not None:
+                by_curie.append(match.group(2))
+            else:
+                by_name.append(name)
+        if by_name and self.name_index is False:
+            logger.warning("looking up names without an index", extra={"fields": {"names": by_name}})
+        # IN seeks the name index for each name when there is one, and without it scans once for all of the names
+        # rather than once per name
+        cypher = f'MATCH (a:`{NODE_LABEL}`) WHERE a.name IN $names RETURN a.id AS id, a.name AS n ' \
+                 f'UNION ' \
+                 f'UNWIND $curies AS curie MATCH (a:`{NODE_LABEL}` {{id: curie}}) RETURN a.id AS id, a.name AS n'
+        results = self.read(cypher, names=by_name, curies=by_curie)
+        for result in sorted(results, key=lambda result: (result['n'] or '', result['id'])):
+            self.nodes.add(result['id'], result['n'])
+
+    def get_curie(self, name):
+        """Return the curie for a blackboard name, going to the neo4j if we haven't seen it before."""
+        curie = self.nodes.curie(name)
+        if curie is None:
+            self.resolve_names([name])
+            curie = self.nodes.curie(name)
+            if curie is None:
+                raise UnknownNode(f"No node named {name}")
+        return curie
+
+    def canonical_name(self, name):
+        """Return the name that the registry holds for the node called name on the blackboard.  They differ when name
+        is "name (curie)" for a node registered under its plain name, and triples have to use the registry's."""
+        return self.nodes.name(self.get_curie(name))
 
     def get_neighborhood_schema(self, name):
         """Given a name, find the types of connections for that node in the neo4j.
-        1. Get the curie for the name from name_to_curie.
-        2. Query the neo4j to return counts for (curie, predicate, ?)
-        3. Query then neo4j to return counts for (?, predicate, curie)
-        4. Return a list of tuples [ (name, predicate, count), ..., (count, predicate, name), ...]
+        Return a list of tuples [ (name, predicate, count), ..., (count, predicate, name), ...]
+        """
+        return self.get_neighborhood_schemas([name])
+
+    @traced("neo4j.get_neighborhood_schemas")
+    def get_neighborhood_schemas(self, names):
+        """Given a list of names, find the types of connections for all of those nodes in a single query.
+        1. Get the curie for each name from nodes, looking up any that we haven't seen.  The triples use the name that
+           nodes holds for each curie, which may not be the one given.
+        2. Query the neo4j once to return the direction, predicate and count of every edge around each curie
+        3. Return a list of tuples [ (name, predicate, count), ..., (count, predicate, name), ...], grouped by name
+           in the order given, with the forward edges for each name before the reverse edges
         """
+        self.resolve_names(names)
+        curie_to_name = {}
+        for name in names:
+            curie = self.get_curie(name)
+            curie_to_name[curie] = self.nodes.name(curie)
+        forward = {curie: [] for curie in curie_to_name}
+        reverse = {curie: [] for curie in curie_to_name}
+        cypher, parameters = self.neighborhood_query(list(curie_to_name))
+        for result in self.read(cypher, **parameters):
+            name = curie_to_name[result['curie']]
+            if result['forward']:
+                forward[result['curie']].append( (name, result['r'], result['c']) )
+            else:
+                reverse[result['curie']].append( (result['c'], result['r'], name) )
         results = []
-        curie = self.name_to_curie[name]
-        with self.driver.session() as session:
-            forward_results = session.run(f'MATCH (a)-[r]->(b) WHERE a.id = "{curie}" RETURN type(r) as r, COUNT(b) as c')
-            for result in forward_results:
-                results.append( (name, result['r'], result['c']) )
-            reverse_results = session.run(f'MATCH (a)<-[r]-(b) WHERE a.id = "{curie}" RETURN type(r) as r, COUNT(b) as c')
-            for result in reverse_results:
-                results.append( (result['c'], result['r'], name) )
+        for curie in curie_to_name:
+            results += forward[curie] + reverse[curie]
         return results
 
+    def neighborhood_query(self, curies):
+        cypher = f'UNWIND $curies AS curie ' \
+                 f'MATCH (a:`{NODE_LABEL}` {{id: curie}})-[r]-(b) ' \
+                 f'RETURN curie, startNode(r) = a AS forward, type(r) AS r, COUNT(b) AS c'
+        return cypher, {"curies": curies}
+
+    def prefetch_neighborhood_schemas(self, names):
+        """Start the query for get_neighborhood_schemas(names) in the background, if we know all of the names."""
+        curies = [self.nodes.curie(name) for name in names]
+        if None not in curies:
+            cypher, parameters = self.neighborhood_query(list(dict.fromkeys(curies)))
+            self.prefetch_read(cypher, **parameters)
+
     def get_edges(self, edge):
         """Given an edge, which is either of the form (name, predicate, count) or (count, predicate, name),
-        return a list of edges that match the pattern.
-        1. Get the curie for the name from name_to_curie.
-        2. Query the neo4j to return the curies and names of the nodes that match the pattern.
-        3. Put the curie and name of each result into name_to_curie
-        4. Return a list of tuples [ (name, predicate, newname)] or [ (newname, predicate, name)]
+        return a list of all of the edges that match the pattern."""
+        return self.get_edge_page(edge)[0]
+
+    @traced("neo4j.get_edge_page")
+    def get_edge_page(self, edge, limit=None, skip=0, order_by="degree"):
+        """Given an edge, which is either of the form (name, predicate, count) or (count, predicate, name),
+        return one page of the edges that match the pattern.
+        1. Get the curie for the name from nodes, and the name that nodes holds for it, which the results use.
+        2. Query the neo4j to return the curies and names of the nodes that match the pattern, sorted on the server
+           by order_by ("degree" of the new node, number of "publications" on the edge, or None for curie order),
+           skipping the first skip and returning at most limit of them.
+        3. Register the curie and name of each result in nodes
+        4. Return a tuple ( [ (name, predicate, newname)] or [ (newname, predicate, name)], next_skip ), where
+           next_skip is the skip for the following page, or None if this was the last page.
         """
+        forward = isinstance(edge[2], int)
+        curie = self.get_curie(edge[0] if forward else edge[2])
+        node = self.nodes.name(curie)
+        cypher, parameters = self.edge_page_query(edge, curie, limit, skip, order_by)
+        page = self.read(cypher, **parameters)
+        next_skip = None
+        if limit is not None and len(page) > limit:
+            page = page[:limit]
+            next_skip = skip + limit
         results = []
+        for result in page:
+            name = self.nodes.add(result['id'], result['n'])
+            if forward:
+                results.append( (node, edge[1], name) )
+            else:
+                results.append( (name, edge[1], node) )
+        return results, next_skip
+
+    def edge_page_query(self, edge, curie, limit, skip, order_by):
+        if order_by == "degree":
+            score = "COUNT { (b)--() }"
+        elif order_by == "publications":
+            score = "coalesce(size(r.publications), 0)"
+        elif order_by is None:
+            score = "0"
+        else:
+            raise ValueError(f"Invalid order_by: {order_by}")
         if isinstance(edge[2], int):
-            # This is a forward edge
-            curie = self.name_to_curie[edge[0]]
-            with self.driver.session() as session:
-                cypher = f'MATCH (a)-[r:`{edge[1]}`]->(b) WHERE a.id = "{curie}" RETURN b.id as b, b.name as n'
-                forward_results = session.run(cypher)
-                for result in forward_results:
-                    self.name_to_curie[result['n']] = result['b']
-                    results.append( (edge[0], edge[1], result["n"]) )
+            pattern = f'(a:`{NODE_LABEL}` {{id: $curie}})-[r:{rel_type(edge[1])}]->(b)'
         else:
-            # This is a reverse edge
-            curie = self.name_to_curie[edge[2]]
-            with self.driver.session() as session:
-                reverse_results = session.run(f'MATCH (a)<-[r:`{edge[1]}`]-(b) WHERE a.id = "{curie}" RETURN b.id as b, b.name as n')
-                for result in reverse_results:
-                    self.name_to_curie[result['n']] = result['b']
-                    results.append( (result["n"], edge[1], edge[2]) )
-        return results
+            pattern = f'(a:`{NODE_LABEL}` {{id: $curie}})<-[r:{rel_type(edge[1])}]-(b)'
+        # The id isn't returned as b, which would hide the node b from the ORDER BY
+        cypher = f'MATCH {pattern} WITH b, {score} AS score ' \
+                 f'RETURN b.id AS id, b.name AS n ORDER BY score DESC, id SKIP $skip'
+        parameters = {"curie": curie, "skip": skip}
+        if limit is not None:
+            # Ask for one extra row so that we know whether there is another page
+            cypher += ' LIMIT $limit'
+            parameters["limit"] = limit + 1
+        return cypher, parameters
+
+    def prefetch_edge_page(self, edge, limit=None, skip=0, order_by="degree"):
+        """Start the query for get_edge_page with these arguments in the background, if we know the node."""
+        curie = self.nodes.curie(edge[0] if isinstance(edge[2], int) else edge[2])
+        if curie is not None:
+            cypher, parameters = self.edge_page_query(edge, curie, limit, skip, order_by)
+            self.prefetch_read(cypher, **parameters)
+
+    @traced("neo4j.find_paths")
+    def find_paths(self, name1, name2, max_length=3, limit=10, predicates=None, shortest=True):
+        """Find paths between two nodes in the neo4j, ignoring edge direction, so that a chain of several hops can be
+        found in one query instead of one hop per LLM step.
+        1. Get the curies for both names from nodes.
+        2. Query the neo4j for at most limit paths of at most max_length edges, using only the given predicates if
+           there are any.  With shortest, only the shortest paths are returned, which neo4j can find with a
+           bidirectional search; otherwise every path up to max_length is a candidate, shortest first, which can be
+           slow around hub nodes.
+        3. Register the curie and name of each node on the paths in nodes
+        4. Return a list of paths, each a list of (name, predicate, name) triples in the direction of the edge,
+           in order from name1 to name2
+        """
+        self.resolve_names([name1, name2])
+        curie1 = self.get_curie(name1)
+        curie2 = self.get_curie(name2)
+        if curie1 == curie2:
+            return []
+        paths = []
+        cypher, parameters = self.paths_query(curie1, curie2, max_length, limit, predicates, shortest)
+        for result in self.read(cypher, **parameters):
+            names = [self.nodes.add(curie, name) for curie, name in zip(result['ids'], result['names'])]
+            path = []
+            for i, (predicate, forward) in enumerate(zip(result['predicates'], result['forward'])):
+                path.append( (names[i], predicate, names[i+1]) if forward else (names[i+1], predicate, names[i]) )
+            paths.append(path)
+        return paths
+
+    def paths_query(self, curie1, curie2, max_length, limit, predicates, shortest):
+        # The bound on a variable length pattern can't be a parameter, so make sure it's an int before interpolating
+        max_length = int(max_length)
+        if max_length < 1:
+            raise ValueError(f"Invalid max_length: {max_length}")
+        if shortest:
+            pattern = f'p = allShortestPaths((a)-[*..{max_length}]-(b))'
+        else:
+            pattern = f'p = (a)-[*1..{max_length}]-(b)'
+        cypher = f'MATCH (a:`{NODE_LABEL}` {{id: $curie1}}), (b:`{NODE_LABEL}` {{id: $curie2}}) MATCH {pattern} '
+        parameters = {"curie1": curie1, "curie2": curie2, "limit": limit}
+        predicates = predicate_list(predicates)
+        if predicates:
+            cypher += 'WHERE all(r IN relationships(p) WHERE type(r) IN $predicates) '
+            parameters["predicates"] = predicates
+        if not shortest:
+            cypher += 'WITH p ORDER BY length(p) '
+        cypher += 'RETURN [n IN nodes(p) | n.id] AS ids, [n IN nodes(p) | n.name] AS names, ' \
+                  '[r IN relationships(p) | type(r)] AS predicates, ' \
+                  '[i IN range(0, length(p) - 1) | startNode(relationships(p)[i]) = nodes(p)[i]] AS forward ' \
+                  'LIMIT $limit'
+        return cypher, parameters
 
     def detail_edge(self, edge):
-        subject = self.name_to_curie[edge[0]]
-        predicate = edge[1]
-        object = self.name_to_curie[edge[2]]
-        returns = []
-        with self.driver.session() as session:
-            cypher = f'MATCH (a)-[r:`{predicate}`]->(b) WHERE a.id = "{subject}" and b.id = "{object}" RETURN r'
-            print(cypher)
-            edges = session.run(f'MATCH (a)-[r:`{edge[1]}`]->(b) WHERE a.id = "{subject}" and b.id = "{object}" RETURN r')
-            for edge in edges:
-                returns.append(edge['r']._properties)
-        return returns
+        """Given a complete (name, predicate, name) triple, return the properties of every matching edge."""
+        return self.detail_edges([edge])[0]
+
+    @traced("neo4j.detail_edges")
+    def detail_edges(self, edges):
+        """Given a list of complete (name, predicate, name) triples, return the properties of the edges for all of
+        them in a single query.
+        1. Get the curie for every name from nodes, looking up all of the ones that we haven't seen at once.
+        2. Query the neo4j once for every edge that matches any of the triples, returning only the properties in
+           EDGE_DETAIL_PROPERTIES
+        3. Return a list with one entry for each triple, in the order given: a list of property dicts, one for each
+           parallel edge between the two nodes (in the order of their element ids), without the missing properties
+        """
+        self.resolve_names([name for edge in edges for name in (edge[0], edge[2])])
+        rows = [{"i": i, "subject": self.get_curie(edge[0]), "predicate": edge[1], "object": self.get_curie(edge[2])}
+                for i, edge in enumerate(edges)]
+        projection = ", ".join(f".`{name}`" for name in EDGE_DETAIL_PROPERTIES)
+        # The predicate can't be a parameter in the pattern, but there are few edges between two given nodes, so
+        # filtering them on type is cheap and keeps this to one query for any mix of predicates
+        cypher = f'UNWIND $edges AS edge ' \
+                 f'MATCH (a:`{NODE_LABEL}` {{id: edge.subject}})-[rel]->(b:`{NODE_LABEL}` {{id: edge.object}}) ' \
+                 f'WHERE type(rel) = edge.predicate ' \
+                 f'RETURN edge.i AS i, rel {{{projection}}} AS r ORDER BY i, elementId(rel)'
+        logger.debug("detail_edges", extra={"fields": {"cypher": cypher, "edges": rows}})
+        details = [[] for _ in edges]
+        for result in self.read(cypher, edges=rows):
+            details[result['i']].append({key: value for key, value in result['r'].items() if value is not None})
+        return details
@@ -0,0 +1,77 @@
+import json, sqlite3, hashlib, threading
+from collections import OrderedDict
+
+class QueryCache:
+    """Results of read queries, keyed by the normalized query text, its parameters and the graph version, so that
+    an exploration that asks the same question again (or a later run against the same KG snapshot) doesn't have
+    to go back to the neo4j.
+    The most recent max_entries results are held in memory.  If path is given, every result is also stored in a
+    sqlite database there, which outlives the process and can be shared by several runs.
+    The graph version is normally set by the Neo4j that uses the cache; results from other versions are never used.
+    One cache may be shared by several threads."""
+    def __init__(self, max_entries=10000, path=None, graph_version=None):
+        self.max_entries = max_entries
+        self.graph_version = graph_version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT)")
+            self.db.commit()
+
+    def key(self, cypher, parameters):
+        normalized = " ".join(cypher.split())
+        text = json.dumps([self.graph_version, normalized, parameters], sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached result for key, or None if there isn't one."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.db is not None:
+                row = self.db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    result = json.loads(row[0])
+                    self.remember(key, result)
+                    return result
+            self.misses += 1
+            return None
+
+    def contains(self, key):
+        """Whether key is cached in memory, without counting as a lookup."""
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, result):
+        with self.lock:
+            self.remember(key, result)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)",
+                                (key, json.dumps(result, default=str)))
+                self.db.commit()
+
+    def remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                    "entries": len(self.entries)}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,69 @@
+import json, time, logging, threading, functools
+from contextlib import contextmanager
+
+class StructuredFormatter(logging.Formatter):
+    """Formats a record as "time level logger message", followed by the json of any fields passed in
+    extra={"fields": {...}}, so that log lines can be grepped by eye and parsed by machine."""
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + json.dumps(fields, default=str)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+def configure_logging(level=logging.INFO):
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter())
+    logging.basicConfig(level=level, handlers=[handler])
+
+class Tracer:
+    """Collects timed spans (a name, attributes, and the seconds taken) until they are drained, usually once per step.
+    Spans may nest and may be recorded from several threads; each is recorded when it finishes, with the name of the
+    span that was open around it on the same thread."""
+    def __init__(self, logger_name="blindsquirrel.trace"):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logger = logging.getLogger(logger_name)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the body of a with block.  The yielded dict can be given more attributes inside the block."""
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        span = {"name": name}
+        if stack:
+            span["parent"] = stack[-1]
+        span.update(attributes)
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span["seconds"] = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.spans.append(span)
+            self.logger.debug("span", extra={"fields": span})
+
+    def drain(self):
+        """Return the spans recorded since the last drain, and forget them."""
+        with self.lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+def traced(name):
+    """Decorate a method so that each call is a span on self.tracer."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def total_seconds(spans, name):
+    return sum(span["seconds"] for span in spans if span["name"] == name)